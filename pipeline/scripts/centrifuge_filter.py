@@ -0,0 +1,63 @@
+import argparse
+import gzip
+import sys
+
+#Filters a centrifuge classification stream down to reads with a single, classified hit
+#The unique-hit lines are written as a classification table for centrifuge-kreport, so the
+#report comes straight from the first centrifuge pass
+
+
+def open_input(path):
+    if path == "-":
+        return sys.stdin.buffer
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+#Reads from centrifuge's output, grouped by read ID: yields (read_id, lines)
+def classification_groups(stream):
+    stream.readline()
+    current_id = None
+    lines = []
+    for line in stream:
+        read_id = line.split(b"\t", 1)[0]
+        if read_id != current_id and lines:
+            yield current_id, lines
+            lines = []
+        current_id = read_id
+        lines.append(line)
+    if lines:
+        yield current_id, lines
+
+
+#A read is kept when centrifuge assigned it to exactly one taxon (numMatches == 1, taxID != 0)
+def is_unique(lines):
+    if len(lines) != 1:
+        return False
+    fields = lines[0].rstrip(b"\n").split(b"\t")
+    return fields[2] != b"0" and fields[7] == b"1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep centrifuge classifications with a unique hit")
+    parser.add_argument("--classification", default="-", help="Centrifuge -S output, '-' for stdin")
+    parser.add_argument("--unique-tsv", required=True, help="Classification lines of reads with a unique hit")
+    args = parser.parse_args()
+
+    total = kept = 0
+    stream = open_input(args.classification)
+    with open(args.unique_tsv, "wb") as unique_out:
+        unique_out.write(b"readID\tseqID\ttaxID\tscore\t2ndBestScore\thitLength\tqueryLength\tnumMatches\n")
+        for _, lines in classification_groups(stream):
+            total += 1
+            if not is_unique(lines):
+                continue
+            kept += 1
+            unique_out.write(lines[0])
+
+    print(f"Kept {kept} of {total} classified reads with a unique hit", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
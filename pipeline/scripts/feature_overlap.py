@@ -0,0 +1,109 @@
+import argparse
+import re
+from collections import defaultdict
+import numpy as np
+import pysam
+
+#Reads overlapping each feature type of the annotation BED (replaces gene_type.sh / bedtools intersect -c)
+#Features of each type are kept as sorted start and end arrays per contig, so the number of features an
+#alignment [s, e) overlaps is (#starts < e) - (#ends <= s), looked up with searchsorted for a block of
+#alignments at a time. Percentages match the bedtools version: (count + 1) / (total + 1) * 100 per type.
+
+
+def read_features(bed_file):
+    features = defaultdict(lambda: defaultdict(lambda: ([], [])))
+    with open(bed_file) as fh:
+        for line in fh:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 4 or line.startswith(("#", "track", "browser")):
+                continue
+            feature_type = fields[3].split(":")[0]
+            starts, ends = features[fields[0]][feature_type]
+            starts.append(int(fields[1]))
+            ends.append(int(fields[2]))
+    index = {}
+    for contig, types in features.items():
+        index[contig] = {
+            feature_type: (np.sort(np.array(starts, dtype=np.int64)), np.sort(np.array(ends, dtype=np.int64)))
+            for feature_type, (starts, ends) in types.items()
+        }
+    return index
+
+
+#BED contig for a BAM contig (the BED made in index.sh drops the accession version, e.g. NC_000913.3 -> NC_000913)
+def bed_contig(contig, index):
+    if contig in index:
+        return contig
+    unversioned = re.sub(r"\.\d+$", "", contig)
+    return unversioned if unversioned in index else None
+
+
+class FeatureCounter:
+    def __init__(self, index, feature_types, block_size=1 << 16):
+        self.index = index
+        self.counts = dict.fromkeys(feature_types, 0)
+        self.block_size = block_size
+        self.contig = None
+        self.starts = []
+        self.ends = []
+
+    def add(self, contig, start, end):
+        if contig != self.contig:
+            self.flush()
+            self.contig = contig
+        self.starts.append(start)
+        self.ends.append(end)
+        if len(self.starts) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        types = self.index.get(self.contig) if self.contig is not None else None
+        if types and self.starts:
+            starts = np.array(self.starts, dtype=np.int64)
+            ends = np.array(self.ends, dtype=np.int64)
+            for feature_type, (feature_starts, feature_ends) in types.items():
+                overlaps = np.searchsorted(feature_starts, ends, side="left") - np.searchsorted(feature_ends, starts, side="right")
+                self.counts[feature_type] += int(overlaps.sum())
+        self.starts = []
+        self.ends = []
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Percentage of reads overlapping each annotation feature type")
+    parser.add_argument("bed", help="Annotation BED, feature type is the part of column 4 before ':'")
+    parser.add_argument("bam", help="Coordinate sorted, indexed BAM")
+    parser.add_argument("output", help="MultiQC table (*_feature_overlap_mqc.tsv)")
+    parser.add_argument("--header", help="MultiQC header prepended to the table")
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    index = read_features(args.bed)
+    feature_types = sorted({t for types in index.values() for t in types})
+    counter = FeatureCounter(index, feature_types)
+
+    bam = pysam.AlignmentFile(args.bam, "rb", threads=args.threads)
+    contigs = [bed_contig(name, index) for name in bam.references]
+    missing = [name for name, contig in zip(bam.references, contigs) if contig is None]
+    if missing:
+        print(f"WARNING: contigs not in {args.bed}: {', '.join(missing[:5])}", flush=True)
+
+    for read in bam.fetch(until_eof=True):
+        if read.is_unmapped:
+            continue
+        contig = contigs[read.reference_id]
+        if contig is not None:
+            counter.add(contig, read.reference_start, read.reference_end)
+    counter.flush()
+    bam.close()
+
+    total = sum(counter.counts.values())
+    with open(args.output, "w") as out:
+        if args.header:
+            with open(args.header) as fh:
+                out.write(fh.read())
+        for feature_type in feature_types:
+            out.write(f"{feature_type}\t{(counter.counts[feature_type] + 1) / (total + 1) * 100:.4f}\n")
+
+
+if __name__ == "__main__":
+    main()
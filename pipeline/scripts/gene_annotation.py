@@ -0,0 +1,158 @@
+import argparse
+import re
+import subprocess
+import sys
+from urllib.parse import unquote
+import pandas as pd
+
+#Gene annotation for the featureCounts table without going to NCBI on every run (replaces get_metadata.sh)
+#build:    GeneID -> symbol and summary table from the reference GFF, made once next to the annotation
+#          (index.sh builds it with --ncbi-summaries, which fills in the NCBI gene summaries with one esummary
+#          pass; without it the summary is the product/description of the gene from the GFF)
+#annotate: joins the table onto all_samples_raw_counts.txt and writes the extended and gene symbol tables
+
+TABLE_COLUMNS = ["gene_id", "symbol", "summary"]
+
+
+def parse_attributes(field):
+    attributes = {}
+    for item in field.strip().split(";"):
+        if "=" in item:
+            key, value = item.split("=", 1)
+            attributes[key] = unquote(value)
+    return attributes
+
+
+def gene_id_of(dbxref):
+    match = re.search(r"GeneID:(\d+)", dbxref or "")
+    return match.group(1) if match else None
+
+
+#Genes (and pseudogenes) with their GeneID, named from Name/gene and described by the product of their children
+def table_from_gff(gff_file):
+    genes = {}
+    products = {}
+    with open(gff_file) as fh:
+        for line in fh:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 9:
+                continue
+            attributes = parse_attributes(fields[8])
+            if fields[2] in ("gene", "pseudogene"):
+                gene_id = gene_id_of(attributes.get("Dbxref"))
+                if gene_id and gene_id not in genes:
+                    genes[gene_id] = {
+                        "id": attributes.get("ID"),
+                        "symbol": attributes.get("Name") or attributes.get("gene") or attributes.get("locus_tag"),
+                        "description": attributes.get("description"),
+                    }
+            elif "Parent" in attributes and "product" in attributes:
+                products.setdefault(attributes["Parent"], attributes["product"])
+
+    rows = []
+    for gene_id, gene in genes.items():
+        summary = products.get(gene["id"]) or gene["description"] or "NA"
+        rows.append((gene_id, gene["symbol"] or "NA", summary))
+    table = pd.DataFrame(rows, columns=TABLE_COLUMNS)
+    return table.sort_values("gene_id", key=lambda ids: ids.astype(int)).reset_index(drop=True)
+
+
+#NCBI gene summaries, fetched once when the table is built
+def ncbi_summaries(gene_ids, batch_size=500):
+    summaries = {}
+    for start in range(0, len(gene_ids), batch_size):
+        batch = ",".join(gene_ids[start:start + batch_size])
+        result = subprocess.run(
+            f"esummary -db gene -id {batch} | xtract -pattern DocumentSummary -element Id Summary",
+            shell=True, check=True, capture_output=True, text=True,
+        )
+        for line in result.stdout.splitlines():
+            fields = line.split("\t", 1)
+            if len(fields) == 2 and fields[1].strip():
+                summary = re.sub(r"\s+", " ", fields[1])
+                summaries[fields[0]] = re.sub(r"\[More information.*$", "", summary).strip()
+        print(f"Fetched summaries for {min(start + batch_size, len(gene_ids))} of {len(gene_ids)} genes", file=sys.stderr)
+    return summaries
+
+
+def load_table(args):
+    if args.table:
+        return pd.read_csv(args.table, sep="\t", dtype=str, keep_default_na=False)
+    return table_from_gff(args.gff)
+
+
+def clean_text(values):
+    return values.fillna("NA").str.replace(r"[\t\r\n]+", " ", regex=True)
+
+
+def write_tsv(path, header, df):
+    with open(path, "w") as out:
+        out.write("\t".join(header) + "\n")
+        for row in df.itertuples(index=False):
+            out.write("\t".join(row) + "\n")
+
+
+def annotate(counts_file, table, extended_file, clean_file):
+    counts = pd.read_csv(counts_file, sep="\t", comment="#", dtype=str, keep_default_na=False)
+    dbxref = counts.columns[0]
+    gene_ids = counts[dbxref].str.extract(r"GeneID:(\d+)", expand=False)
+    meta = table.set_index("gene_id")
+
+    #Genes missing from the table keep their Dbxref field as the symbol, like the esummary version did
+    symbol = gene_ids.map(meta["symbol"])
+    summary = gene_ids.map(meta["summary"])
+    extended = pd.concat([
+        pd.DataFrame({
+            "Gene_Symbol": clean_text(symbol.where(symbol.notna(), counts[dbxref])),
+            "Gene_IDs_Field": counts[dbxref],
+            "Gene_Summary": clean_text(summary),
+        }),
+        counts.iloc[:, 1:],
+    ], axis=1)
+    header = ["Gene_Symbol", "Gene_IDs_Field", "Gene_Summary"] + list(counts.columns[1:])
+    write_tsv(extended_file, header, extended)
+    if clean_file:
+        clean_columns = [0] + list(range(3, extended.shape[1]))
+        write_tsv(clean_file, [header[i] for i in clean_columns], extended.iloc[:, clean_columns])
+
+    unmatched = int(symbol.isna().sum())
+    if unmatched:
+        print(f"WARNING: {unmatched} of {len(counts)} genes not found in the gene annotation table", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local gene annotation for featureCounts output")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build the gene annotation table from the reference GFF")
+    build_parser.add_argument("--gff", required=True)
+    build_parser.add_argument("--output", required=True)
+    build_parser.add_argument("--ncbi-summaries", action="store_true", help="Use NCBI gene summaries (needs entrez-direct)")
+
+    annotate_parser = subparsers.add_parser("annotate", help="Annotate all_samples_raw_counts.txt")
+    source = annotate_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--table", help="Table made by the build command")
+    source.add_argument("--gff", help="Reference GFF, the table is derived on the fly")
+    annotate_parser.add_argument("--counts", required=True)
+    annotate_parser.add_argument("--extended", required=True, help="all_samples_counts_extended.tsv")
+    annotate_parser.add_argument("--clean", help="all_samples_gene_symbols.tsv")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        table = table_from_gff(args.gff)
+        if args.ncbi_summaries:
+            summaries = ncbi_summaries(table["gene_id"].tolist())
+            table["summary"] = table["gene_id"].map(summaries).fillna(table["summary"])
+        table["summary"] = clean_text(table["summary"])
+        table.to_csv(args.output, sep="\t", index=False)
+        print(f"Wrote {len(table)} genes to {args.output}", file=sys.stderr)
+    else:
+        if args.gff:
+            print("WARNING: No gene annotation table, Gene_Summary holds GFF product descriptions instead of NCBI gene summaries", file=sys.stderr)
+        annotate(args.counts, load_table(args), args.extended, args.clean)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import argparse
+import gzip
+import json
+from itertools import islice
+import numpy as np
+
+#Read-length stats for a sample after fastp and the vg minimizer index that goes with them
+#Mean length and read counts come from the fastp JSON; min/max and the length distribution come from
+#the first reads of the cleaned FASTQ. The minimizer choice is written as the index suffix so it does not
+#depend on where the vg index is mounted
+
+
+def fastp_lengths(json_file):
+    with open(json_file) as fh:
+        data = json.load(fh)
+    after = data.get("summary", {}).get("after_filtering", {})
+    stats = {
+        "total_reads": after.get("total_reads"),
+        "total_bases": after.get("total_bases"),
+        "read1_mean_length": after.get("read1_mean_length"),
+        "read2_mean_length": after.get("read2_mean_length"),
+    }
+    #Per-cycle curves are as long as the longest read
+    for read in ("read1", "read2"):
+        curves = data.get(f"{read}_after_filtering", {}).get("quality_curves", {}).get("mean")
+        if curves:
+            stats[f"{read}_max_cycles"] = len(curves)
+    return stats
+
+
+def probe_lengths(fastq_file, max_reads):
+    opener = gzip.open if fastq_file.endswith(".gz") else open
+    with opener(fastq_file, "rt") as fh:
+        lengths = [len(line.rstrip("\n")) for line in islice(fh, 1, max_reads * 4, 4)]
+    if not lengths:
+        return {}
+    lengths = np.array(lengths)
+    values, counts = np.unique(lengths, return_counts=True)
+    return {
+        "probe_reads": int(len(lengths)),
+        "min_length": int(lengths.min()),
+        "max_length": int(lengths.max()),
+        "median_length": float(np.median(lengths)),
+        "length_distribution": {int(v): int(c) for v, c in zip(values, counts)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read-length stats and vg minimizer choice for a sample")
+    parser.add_argument("--fastp-json", required=True)
+    parser.add_argument("--fastq", help="Cleaned read 1 FASTQ, probed for the length distribution")
+    parser.add_argument("--stats", required=True, help="Read-length stats (JSON)")
+    parser.add_argument("--minimizer", required=True, help="Minimizer index suffix for the sample")
+    parser.add_argument("--short-read-length", type=float, default=50, help="Reads shorter than this use the k=15 index")
+    parser.add_argument("--probe-reads", type=int, default=10000)
+    args = parser.parse_args()
+
+    stats = fastp_lengths(args.fastp_json)
+    if args.fastq:
+        stats.update(probe_lengths(args.fastq, args.probe_reads))
+
+    mean_length = stats.get("read1_mean_length") or stats.get("median_length")
+    if mean_length and mean_length < args.short_read_length:
+        stats["minimizer"] = ".d2.k15.min"
+    else:
+        stats["minimizer"] = ".d2.min"
+    print(f"Average read length = {mean_length}bp, using minimizer {stats['minimizer']}", flush=True)
+
+    with open(args.stats, "w") as out:
+        json.dump(stats, out, indent=2)
+    with open(args.minimizer, "w") as out:
+        out.write(stats["minimizer"] + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import os
+import re
+import sys
+from collections import Counter
+
+#Library strandedness for featureCounts from RSeQC infer_experiment.py outputs (replaces parse_strandedness.py)
+#Each sample is called 1 (forward), 2 (reverse) or 0 (unstranded) when the fraction of reads explained by
+#that orientation is over the threshold. Samples are checked against each other and any sample that
+#disagrees with the majority call is flagged. Prints "<consensus> <comma separated per-sample calls>"
+#(featureCounts -s accepts one value per input file)
+
+#Single-end and paired-end wording of infer_experiment.py
+FORWARD = re.compile(r'"(?:\+\+,--|1\+\+,1--,2\+-,2-\+)":\s*([0-9.]+)')
+REVERSE = re.compile(r'"(?:\+-,-\+|1\+-,1-\+,2\+\+,2--)":\s*([0-9.]+)')
+FAILED = re.compile(r"Fraction of reads failed to determine:\s*([0-9.]+)")
+
+
+def parse_infer_experiment(path):
+    with open(path) as fh:
+        text = fh.read()
+    fractions = {}
+    for key, pattern in (("forward", FORWARD), ("reverse", REVERSE), ("undetermined", FAILED)):
+        match = pattern.search(text)
+        fractions[key] = float(match.group(1)) if match else 0.0
+    return fractions
+
+
+def call_strand(fractions, threshold):
+    if fractions["forward"] > threshold:
+        return "1"
+    if fractions["reverse"] > threshold:
+        return "2"
+    return "0"
+
+
+#Sample name from <sample>_infer_experiment.txt
+def sample_name(path):
+    return os.path.basename(path).replace("_infer_experiment.txt", "")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="featureCounts strandedness from infer_experiment.py outputs")
+    parser.add_argument("infer_experiment", nargs="+", help="infer_experiment.py outputs, in the order of the BAM files")
+    parser.add_argument("--threshold", type=float, default=0.8, help="Fraction of reads needed to call a library stranded")
+    parser.add_argument("--table", help="Per-sample fractions and calls (TSV)")
+    args = parser.parse_args()
+
+    rows = []
+    for path in args.infer_experiment:
+        fractions = parse_infer_experiment(path)
+        rows.append((sample_name(path), fractions, call_strand(fractions, args.threshold)))
+
+    #Majority call, unstranded on a tie
+    counts = Counter(call for _, _, call in rows).most_common()
+    consensus = counts[0][0]
+    if len(counts) > 1 and counts[0][1] == counts[1][1]:
+        consensus = "0"
+
+    mismatched = [name for name, _, call in rows if call != consensus]
+    if mismatched:
+        print(
+            f"WARNING: strandedness of {len(mismatched)} of {len(rows)} samples differs from the consensus "
+            f"({consensus}): {', '.join(mismatched)}. Counting them with their own setting.",
+            file=sys.stderr, flush=True,
+        )
+
+    if args.table:
+        with open(args.table, "w") as out:
+            out.write("sample\tforward\treverse\tundetermined\tstrand\tagrees_with_consensus\n")
+            for name, fractions, call in rows:
+                out.write(
+                    f"{name}\t{fractions['forward']:.4f}\t{fractions['reverse']:.4f}\t{fractions['undetermined']:.4f}"
+                    f"\t{call}\t{'yes' if call == consensus else 'no'}\n"
+                )
+
+    print(consensus, ",".join(call for _, _, call in rows))
+
+
+if __name__ == "__main__":
+    main()
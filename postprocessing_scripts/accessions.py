@@ -0,0 +1,187 @@
+import csv
+import io
+import math
+import os
+import re
+import sqlite3
+import subprocess
+import time
+from contextlib import contextmanager
+from ncbi import run_with_retry
+
+
+#Run information kept for every GSM, taken from the SRA runinfo table
+RUN_COLUMNS = ["srr", "layout", "read_length", "spots", "bases", "size_mb", "fastq_bytes"]
+#Records per efetch request when it pages through an esearch result (at most, to stay on the safe side of the limit)
+EFETCH_PAGE_SIZE = 100
+
+
+#Local GSM -> SRR cache so restarted jobs do not go back to NCBI for samples already resolved
+#GSMs that NCBI resolved to no runs are stored too (resolved without rows in runs); they are looked up
+#again once older than missing_ttl_days, in case the runs have been released since
+class AccessionCache:
+    def __init__(self, path, missing_ttl_days=30):
+        self.path = path
+        self.missing_ttl = missing_ttl_days * 86400
+        with self.connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "gsm TEXT NOT NULL, srr TEXT NOT NULL, layout TEXT, read_length REAL, "
+                "spots INTEGER, bases INTEGER, size_mb REAL, fastq_bytes INTEGER, "
+                "PRIMARY KEY (gsm, srr))"
+            )
+            con.execute("CREATE TABLE IF NOT EXISTS resolved (gsm TEXT PRIMARY KEY, resolved_at REAL)")
+
+    #Fresh connection per call so the cache can be shared by download threads and concurrent slurm jobs
+    @contextmanager
+    def connect(self):
+        con = sqlite3.connect(self.path, timeout=60)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    #Cached runs for the GSMs that have been resolved before, {gsm: [run, ...]}
+    #(an empty list for GSMs without runs, unless that answer has expired)
+    def lookup(self, gsms):
+        gsms = list(gsms)
+        found = {}
+        resolved_at = {}
+        with self.connect() as con:
+            for start in range(0, len(gsms), 500):
+                batch = gsms[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                for gsm, at in con.execute(f"SELECT gsm, resolved_at FROM resolved WHERE gsm IN ({placeholders})", batch):
+                    found[gsm] = []
+                    resolved_at[gsm] = at
+                rows = con.execute(
+                    f"SELECT gsm, {', '.join(RUN_COLUMNS)} FROM runs WHERE gsm IN ({placeholders}) ORDER BY gsm, srr",
+                    batch,
+                )
+                for row in rows:
+                    if row[0] in found:
+                        found[row[0]].append(dict(zip(RUN_COLUMNS, row[1:])))
+        now = time.time()
+        for gsm, runs in list(found.items()):
+            if not runs and now - (resolved_at[gsm] or 0) > self.missing_ttl:
+                del found[gsm]
+        return found
+
+    def store(self, runs_by_gsm):
+        with self.connect() as con:
+            for gsm, runs in runs_by_gsm.items():
+                con.execute("DELETE FROM runs WHERE gsm = ?", (gsm,))
+                con.executemany(
+                    f"INSERT OR REPLACE INTO runs (gsm, {', '.join(RUN_COLUMNS)}) VALUES (?{', ?' * len(RUN_COLUMNS)})",
+                    [(gsm, *[run.get(c) for c in RUN_COLUMNS]) for run in runs],
+                )
+                con.execute("INSERT OR REPLACE INTO resolved (gsm, resolved_at) VALUES (?, ?)", (gsm, time.time()))
+
+    #Recording the size of the downloaded FASTQ files for a run
+    def set_fastq_bytes(self, gsm, srr, fastq_bytes):
+        with self.connect() as con:
+            con.execute("UPDATE runs SET fastq_bytes = ? WHERE gsm = ? AND srr = ?", (fastq_bytes, gsm, srr))
+
+
+def to_number(value, cast):
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+
+#One multi-ID esearch/efetch lookup, returns the runinfo rows as dictionaries
+#esearch and efetch run separately so each is charged to the limiter for the requests it makes: one for the
+#search, one per page of results for the fetch
+def fetch_runinfo(gsms, limiter):
+    query = " OR ".join(f"{gsm}[All]" for gsm in gsms)
+    search = run_with_retry(
+        f"esearch -db sra -query '{query}'", f"E-utility search for {len(gsms)} GSMs", limiter=limiter,
+        capture_output=True, text=True,
+    )
+    count = re.search(r"<Count>(\d+)</Count>", search.stdout)
+    count = int(count.group(1)) if count else 0
+    if count == 0:
+        return []
+    result = run_with_retry(
+        "efetch -format runinfo", f"E-utility fetch for {len(gsms)} GSMs", limiter=limiter,
+        requests=math.ceil(count / EFETCH_PAGE_SIZE), input=search.stdout, capture_output=True, text=True,
+    )
+    rows = []
+    for row in csv.DictReader(io.StringIO(result.stdout)):
+        #efetch repeats the header line between result pages
+        if row.get("Run", "").startswith("SRR"):
+            rows.append(row)
+    return rows
+
+
+def runinfo_to_run(row):
+    return {
+        "srr": row["Run"],
+        "layout": "PE" if row.get("LibraryLayout", "").upper() == "PAIRED" else "SE",
+        "read_length": to_number(row.get("avgLength"), float),
+        "spots": to_number(row.get("spots"), int),
+        "bases": to_number(row.get("bases"), int),
+        "size_mb": to_number(row.get("size_MB"), float),
+        "fastq_bytes": None,
+    }
+
+
+#Resolving GSMs to SRR runs, using the cache first and batched NCBI queries for the misses
+def resolve_gsms(gsms, cache, limiter, batch_size=100):
+    gsms = list(dict.fromkeys(gsms))
+    runs_by_gsm = cache.lookup(gsms) if cache is not None else {}
+    misses = [gsm for gsm in gsms if gsm not in runs_by_gsm]
+    if runs_by_gsm:
+        without_runs = sum(1 for runs in runs_by_gsm.values() if not runs)
+        print(f"[INFO] {len(runs_by_gsm)} GSMs found in accession cache ({without_runs} without SRR runs)", flush=True)
+
+    resolved = {}
+    #GSMs NCBI answered for with no runs (failed queries are not cached and are retried next time)
+    not_found = []
+    for start in range(0, len(misses), batch_size):
+        batch = misses[start:start + batch_size]
+        try:
+            rows = fetch_runinfo(batch, limiter)
+        except subprocess.CalledProcessError as e:
+            print(f"ERROR: Batched E-utility search failed with exit code {e.returncode}.", flush=True)
+            print(f"Stderr: {e.stderr}", flush=True)
+            rows = []
+
+        #GEO submissions carry the GSM in SampleName (or LibraryName) of the runinfo table
+        wanted = set(batch)
+        for row in rows:
+            for field in ("SampleName", "LibraryName"):
+                if row.get(field) in wanted:
+                    resolved.setdefault(row[field], []).append(runinfo_to_run(row))
+                    break
+
+        #Anything that could not be matched in the batch is looked up on its own
+        for gsm in batch:
+            if gsm in resolved:
+                continue
+            try:
+                rows = fetch_runinfo([gsm], limiter)
+            except subprocess.CalledProcessError as e:
+                print(f"ERROR: E-utility search failed for {gsm} with exit code {e.returncode}. ", flush=True)
+                print(f"Stderr: {e.stderr}", flush=True)
+                continue
+            if rows:
+                resolved[gsm] = [runinfo_to_run(row) for row in rows]
+            else:
+                not_found.append(gsm)
+
+    for gsm in misses:
+        if gsm not in resolved:
+            print(f"WARNING: No SRR runs found for {gsm}.", flush=True)
+    resolved.update((gsm, []) for gsm in not_found)
+    if cache is not None and resolved:
+        cache.store(resolved)
+    runs_by_gsm.update(resolved)
+    return runs_by_gsm
+
+
+#Default cache location, next to the finished list used by process.py
+def default_cache_path():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "accessions.sqlite")
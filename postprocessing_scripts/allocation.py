@@ -0,0 +1,16 @@
+import os
+
+
+#Cores and memory (MB) for snakemake from the slurm allocation, or the whole machine outside slurm
+#(10% of the memory is left for snakemake itself and the download stage)
+#Shared by process.py and parse.py, which converts estimated core-seconds to walltime for the same cores
+def allocated_resources():
+    cores = os.environ.get("SLURM_CPUS_PER_TASK") or os.environ.get("SLURM_CPUS_ON_NODE")
+    cores = int(cores) if cores else len(os.sched_getaffinity(0))
+    if os.environ.get("SLURM_MEM_PER_NODE"):
+        mem_mb = int(os.environ["SLURM_MEM_PER_NODE"])
+    elif os.environ.get("SLURM_MEM_PER_CPU"):
+        mem_mb = int(os.environ["SLURM_MEM_PER_CPU"]) * cores
+    else:
+        mem_mb = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 1024**2
+    return cores, int(mem_mb * 0.9)
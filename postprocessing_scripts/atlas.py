@@ -0,0 +1,427 @@
+#Building the combined expression atlas from the per-GSE featureCounts tables (replaces combine_counts.sh)
+#The atlas is a directory holding:
+#   genes.tsv     gene symbols in row order
+#   samples.tsv   sample, gse and column number of every sample
+#   counts.bin    int32 counts, one contiguous block of genes per sample (samples x genes, C order)
+#   genes.*.bin   the same counts transposed (genes x samples), so reading a few genes touches a few blocks;
+#                 one file per build holding the samples that build added (atlas.py index merges them)
+#   atlas.json    shape, dtype and the list of gene-major files
+#Each sample is one contiguous block, so adding a finished GSE appends to the end of counts.bin
+#A full build is written to {atlas}.building and swapped in when complete, so the old atlas stays usable
+#The Atlas class reads slices of either layout through memory maps without loading the matrix
+#normalize.py adds size_factors.tsv and vst.bin (atlas-wide normalization), which Atlas.get can return instead
+import os
+import sys
+import glob
+import json
+import shutil
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+
+
+COUNTS_DTYPE = np.int32
+#Columns of all_samples_counts_extended.tsv before the per-sample counts
+#(Gene_Symbol, Gene_IDs_Field, Gene_Summary, Chr, Start, End, Strand, Length)
+FIRST_COUNT_COLUMN = 8
+
+
+#Counts files for every finished GSE under a run root
+def find_counts_files(root):
+    files = {}
+    for gse_dir in sorted(glob.glob(os.path.join(root, "GSE*/"))):
+        gse = os.path.basename(os.path.normpath(gse_dir))
+        counts_file = os.path.join(gse_dir, f"{gse}_results", "all_samples_counts_extended.tsv")
+        if os.path.isfile(counts_file):
+            files[gse] = counts_file
+        else:
+            print(f"Skipping {gse} (no counts file found)", flush=True)
+    return files
+
+
+#Sample names from the featureCounts header (paths to *_sort.bam)
+def sample_names(counts_file):
+    with open(counts_file) as fh:
+        header = fh.readline().rstrip("\n").split("\t")
+    return [os.path.basename(h).split("_sort")[0] for h in header[FIRST_COUNT_COLUMN:]]
+
+
+def read_genes(counts_file):
+    return pd.read_csv(counts_file, sep="\t", usecols=[0], dtype=str).iloc[:, 0]
+
+
+#Counts of one GSE aligned to the global gene order (genes missing from the GSE are 0)
+def read_counts(counts_file, gene_index):
+    samples = sample_names(counts_file)
+    df = pd.read_csv(
+        counts_file, sep="\t", index_col=0,
+        usecols=[0] + list(range(FIRST_COUNT_COLUMN, FIRST_COUNT_COLUMN + len(samples))),
+    )
+    df.index = df.index.astype(str)
+    if df.index.has_duplicates:
+        print(f"[WARN] Duplicate gene symbols in {counts_file}, keeping the first row", flush=True)
+        df = df[~df.index.duplicated()]
+    rows = gene_index.get_indexer(df.index)
+    block = np.zeros((len(samples), len(gene_index)), dtype=COUNTS_DTYPE)
+    block[:, rows] = df.to_numpy(dtype=COUNTS_DTYPE).T
+    return samples, block
+
+
+def read_json(path):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def write_json(path, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as fh:
+        json.dump(data, fh, indent=2)
+    os.replace(tmp, path)
+
+
+#Shape of the store as recorded in atlas.json (see write_metadata for the pending shape)
+#genes.tsv and samples.tsv are read up to that shape
+def load_store(atlas_dir):
+    meta = read_json(os.path.join(atlas_dir, "atlas.json"))
+    pending = meta.pop("pending", None)
+    if pending is not None:
+        counts_size = os.path.getsize(os.path.join(atlas_dir, "counts.bin"))
+        if counts_size == pending["n_samples"] * pending["n_genes"] * np.dtype(pending["dtype"]).itemsize:
+            meta = pending
+    genes = pd.read_csv(os.path.join(atlas_dir, "genes.tsv"), sep="\t", dtype=str)["gene"]
+    samples = pd.read_csv(os.path.join(atlas_dir, "samples.tsv"), sep="\t", dtype={"sample": str, "gse": str})
+    return meta, pd.Index(genes[:meta["n_genes"]]), samples.iloc[:meta["n_samples"]].reset_index(drop=True)
+
+
+#Identity of the counts a normalization was computed from: the sample list and counts.bin as last written
+#(normalize.py stores it, Atlas only uses normalized values while it still matches)
+def store_fingerprint(atlas_dir, samples):
+    stat = os.stat(os.path.join(atlas_dir, "counts.bin"))
+    listing = "\n".join(samples["sample"].astype(str) + "\t" + samples["gse"].astype(str))
+    return {
+        "samples_sha1": hashlib.sha1(listing.encode()).hexdigest(),
+        "counts_bytes": stat.st_size,
+        "counts_mtime": stat.st_mtime,
+    }
+
+
+#Metadata is written last (and atomically), so an interrupted build never looks complete
+#Genes and samples are only ever added at the end, so genes.tsv/samples.tsv can go first. A counts.bin of a
+#new width (counts_tmp, written when new genes widen every sample block) is swapped in between two writes of
+#atlas.json: the first keeps the old shape and records the new one as pending, and load_store uses the
+#pending shape only when counts.bin already has its size
+def write_metadata(atlas_dir, genes, samples, blocks, counts_tmp=None):
+    for name, df in (("genes.tsv", pd.DataFrame({"gene": genes})), ("samples.tsv", samples)):
+        tmp = os.path.join(atlas_dir, f"{name}.tmp")
+        df.to_csv(tmp, sep="\t", index=False)
+        os.replace(tmp, os.path.join(atlas_dir, name))
+    meta_path = os.path.join(atlas_dir, "atlas.json")
+    meta = {"n_genes": len(genes), "n_samples": len(samples), "dtype": np.dtype(COUNTS_DTYPE).name, "gene_blocks": blocks}
+    if counts_tmp is not None:
+        previous = read_json(meta_path)
+        previous.pop("pending", None)
+        write_json(meta_path, dict(previous, pending=meta))
+        os.replace(counts_tmp, os.path.join(atlas_dir, "counts.bin"))
+    write_json(meta_path, meta)
+    remove_unused_blocks(atlas_dir, blocks)
+
+
+#Copy of counts.bin with rows for new genes (written one sample block at a time to counts_tmp,
+#counts.bin itself is only replaced by write_metadata)
+def extend_genes(atlas_dir, counts_tmp, old_n_genes, n_samples, new_n_genes, chunk_samples=1024):
+    old = np.memmap(os.path.join(atlas_dir, "counts.bin"), dtype=COUNTS_DTYPE, mode="r", shape=(n_samples, old_n_genes))
+    with open(counts_tmp, "wb") as out:
+        for start in range(0, n_samples, chunk_samples):
+            block = np.zeros((min(chunk_samples, n_samples - start), new_n_genes), dtype=COUNTS_DTYPE)
+            block[:, :old_n_genes] = old[start:start + chunk_samples]
+            block.tofile(out)
+    del old
+
+
+#Gene-major copy of the samples [first, end) of counts.bin, written one block of samples at a time
+#A build only writes the samples it added, so an append costs the size of the new GSEs. The file is
+#listed in atlas.json by write_metadata; genes added by later builds are not in it and read as 0
+def write_gene_block(atlas_dir, counts_path, n_genes, first, end, chunk_samples=1024):
+    name = f"genes.{first}-{end}.g{n_genes}.bin"
+    counts = np.memmap(counts_path, dtype=COUNTS_DTYPE, mode="r", shape=(end, n_genes))
+    by_gene = np.memmap(os.path.join(atlas_dir, name), dtype=COUNTS_DTYPE, mode="w+", shape=(n_genes, end - first))
+    for start in range(first, end, chunk_samples):
+        stop = min(start + chunk_samples, end)
+        by_gene[:, start - first:stop - first] = counts[start:stop].T
+    by_gene.flush()
+    del by_gene, counts
+    return {"file": name, "first": first, "n_samples": end - first, "n_genes": n_genes}
+
+
+#Gene-major files of a store (stores built before gene_blocks have a single genes.bin)
+def gene_blocks(meta):
+    if "gene_blocks" in meta:
+        return meta["gene_blocks"]
+    return [{"file": "genes.bin", "first": 0, "n_samples": meta["n_samples"], "n_genes": meta["n_genes"]}]
+
+
+#Gene-major files not listed in atlas.json (merged by index, or left by an interrupted build)
+def remove_unused_blocks(atlas_dir, blocks):
+    used = {block["file"] for block in blocks}
+    for path in glob.glob(os.path.join(atlas_dir, "genes*.bin")):
+        if os.path.basename(path) not in used:
+            os.remove(path)
+
+
+#Merging the gene-major files into one, so reading a gene touches a single file (a pass over counts.bin)
+def index(atlas_dir):
+    meta, genes, samples = load_store(atlas_dir)
+    blocks = gene_blocks(meta)
+    if len(blocks) == 1 and blocks[0]["n_genes"] == meta["n_genes"]:
+        print("Gene-major counts are already a single file", flush=True)
+        return
+    print(f"[INFO] Merging {len(blocks)} gene-major files", flush=True)
+    block = write_gene_block(atlas_dir, os.path.join(atlas_dir, "counts.bin"), meta["n_genes"], 0, meta["n_samples"])
+    write_json(os.path.join(atlas_dir, "atlas.json"), dict(meta, gene_blocks=[block]))
+    remove_unused_blocks(atlas_dir, [block])
+
+
+def build(root, atlas_dir, append=False):
+    counts_files = find_counts_files(root)
+    if append and os.path.exists(os.path.join(atlas_dir, "atlas.json")):
+        add_gses(atlas_dir, counts_files)
+        return
+    if not counts_files:
+        print(f"No counts files under {root}, {atlas_dir} is left as it is", flush=True)
+        return
+
+    #Full builds go to a separate directory that replaces the atlas once complete (this also drops
+    #normalize.py outputs, which belong to the old counts)
+    atlas_dir = os.path.normpath(atlas_dir)
+    staging_dir = f"{atlas_dir}.building"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    add_gses(staging_dir, counts_files)
+    if os.path.exists(atlas_dir):
+        old_dir = f"{atlas_dir}.old"
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.replace(atlas_dir, old_dir)
+        os.replace(staging_dir, atlas_dir)
+        shutil.rmtree(old_dir)
+    else:
+        os.replace(staging_dir, atlas_dir)
+
+
+#Appending the samples of GSEs not in the store yet (an empty store when atlas_dir has no atlas.json)
+def add_gses(atlas_dir, counts_files):
+    counts_path = os.path.join(atlas_dir, "counts.bin")
+    blocks = []
+    if os.path.exists(os.path.join(atlas_dir, "atlas.json")):
+        meta, genes, samples = load_store(atlas_dir)
+        blocks = gene_blocks(meta)
+        done = set(samples["gse"])
+        counts_files = {gse: f for gse, f in counts_files.items() if gse not in done}
+        #Dropping anything an interrupted append left past the recorded samples (only when there is something
+        #to drop, truncating also changes the mtime in the normalization fingerprint)
+        recorded_size = meta["n_samples"] * meta["n_genes"] * np.dtype(COUNTS_DTYPE).itemsize
+        if os.path.getsize(counts_path) != recorded_size:
+            with open(counts_path, "r+b") as fh:
+                fh.truncate(recorded_size)
+    else:
+        genes = pd.Index([], dtype=str)
+        samples = pd.DataFrame({"sample": pd.Series(dtype=str), "gse": pd.Series(dtype=str), "column": pd.Series(dtype=int)})
+        open(counts_path, "wb").close()
+
+    if not counts_files:
+        print("No new GSEs to add", flush=True)
+        return
+
+    #Global gene index from the gene column of every new GSE (new genes go after the existing ones)
+    new_genes = set()
+    for counts_file in counts_files.values():
+        new_genes.update(read_genes(counts_file))
+    new_genes = sorted(new_genes.difference(genes))
+    #New genes widen every sample block: the widened copy and the new samples go to counts_tmp, which replaces
+    #counts.bin together with the metadata. Otherwise the new samples are appended to counts.bin in place
+    counts_tmp = None
+    if new_genes:
+        if len(samples):
+            print(f"[INFO] Adding {len(new_genes)} genes to the existing atlas", flush=True)
+            counts_tmp = f"{counts_path}.tmp"
+            extend_genes(atlas_dir, counts_tmp, len(genes), len(samples), len(genes) + len(new_genes))
+        genes = genes.append(pd.Index(new_genes))
+
+    #Counts of each GSE are read once and appended as sample blocks
+    new_rows = []
+    column = len(samples)
+    with open(counts_tmp or counts_path, "ab") as out:
+        for gse, counts_file in counts_files.items():
+            print(f"Processing {gse}...", flush=True)
+            gse_samples, block = read_counts(counts_file, genes)
+            block.tofile(out)
+            for sample in gse_samples:
+                new_rows.append({"sample": sample, "gse": gse, "column": column})
+                column += 1
+
+    first = len(samples)
+    samples = pd.concat([samples, pd.DataFrame(new_rows)], ignore_index=True)
+    blocks = blocks + [write_gene_block(atlas_dir, counts_tmp or counts_path, len(genes), first, len(samples))]
+    write_metadata(atlas_dir, genes, samples, blocks, counts_tmp)
+    print(f"Atlas has {len(genes)} genes x {len(samples)} samples", flush=True)
+    if len(blocks) > 16:
+        print(f"[INFO] Gene-major counts are split over {len(blocks)} files, atlas.py index merges them", flush=True)
+
+
+#Read access to a built atlas
+#   atlas = Atlas("atlas", metrics="sample_metrics.tsv", labels="labeled.txt")
+#   atlas.get(genes=["rpoS", "dnaK"], gse="GSE12345")  -> genes x samples DataFrame
+#   atlas.samples                                      -> sample table with gse, QC metrics and characteristics_ch1
+#   atlas.get(genes=["rpoS"], values="vst")            -> variance-stabilized values (after normalize.py)
+#normalization is the directory normalize.py wrote to (default: the atlas directory)
+class Atlas:
+    def __init__(self, atlas_dir, metrics=None, labels=None, normalization=None):
+        meta, genes, samples = load_store(atlas_dir)
+        shape = (meta["n_samples"], meta["n_genes"])
+        self.by_sample = np.memmap(os.path.join(atlas_dir, "counts.bin"), dtype=meta["dtype"], mode="r", shape=shape)
+        self.gene_blocks = [
+            (block["first"], np.memmap(
+                os.path.join(atlas_dir, block["file"]), dtype=meta["dtype"], mode="r",
+                shape=(block["n_genes"], block["n_samples"]),
+            ))
+            for block in gene_blocks(meta)
+        ]
+        self.genes = genes
+        self.gene_rows = pd.Series(np.arange(len(genes)), index=genes)
+
+        #Normalization from normalize.py, ignored once the counts have changed since (append or rebuild)
+        self.size_factors = None
+        self.vst = None
+        normalization_dir = normalization or atlas_dir
+        normalization_file = os.path.join(normalization_dir, "normalization.json")
+        if os.path.exists(normalization_file):
+            normalization = read_json(normalization_file)
+            if normalization.get("fingerprint") == store_fingerprint(atlas_dir, samples):
+                factors = pd.read_csv(os.path.join(normalization_dir, "size_factors.tsv"), sep="\t")
+                self.size_factors = factors["size_factor"].to_numpy()
+                self.vst = np.memmap(os.path.join(normalization_dir, "vst.bin"), dtype=normalization["vst_dtype"], mode="r", shape=shape)
+            else:
+                print("[WARN] Atlas changed since normalize.py was run, normalized values are not available", file=sys.stderr, flush=True)
+        elif normalization is not None:
+            raise FileNotFoundError(f"No normalize.py output in {normalization}")
+
+        samples = samples.set_index("sample")
+        #Samples are {gsm}_{srr}, labels and metadata are per GSM
+        samples["gsm"] = samples.index.str.split("_").str[0]
+        if metrics is not None:
+            qc = pd.read_csv(metrics, sep="\t", index_col="sample", na_values="NA")
+            samples = samples.join(qc, how="left")
+        if labels is not None:
+            label_df = pd.read_csv(labels, sep="\t", dtype=str, usecols=["gsm", "characteristics_ch1"])
+            label_df = label_df.drop_duplicates("gsm").set_index("gsm")
+            samples = samples.join(label_df, on="gsm", how="left")
+        self.samples = samples
+
+    def sample_columns(self, samples=None, gse=None):
+        selected = self.samples
+        if gse is not None:
+            gses = [gse] if isinstance(gse, str) else list(gse)
+            selected = selected[selected["gse"].isin(gses)]
+        if samples is not None:
+            samples = [samples] if isinstance(samples, str) else list(samples)
+            missing = set(samples).difference(selected.index)
+            if missing:
+                raise KeyError(f"Samples not in atlas (or not in the selected GSEs): {sorted(missing)[:5]}")
+            selected = selected.loc[samples]
+        return selected
+
+    #Counts as a genes x samples DataFrame, only the requested rows/columns are read from disk
+    #(values: "counts", "normalized" for counts / size factor, or "vst")
+    def get(self, genes=None, samples=None, gse=None, values="counts"):
+        if values != "counts" and self.size_factors is None:
+            raise ValueError(f"No {values} values for this atlas, run normalize.py first")
+        columns = self.sample_columns(samples, gse)
+        if genes is None:
+            rows = np.arange(len(self.genes))
+        else:
+            genes = [genes] if isinstance(genes, str) else list(genes)
+            missing = set(genes).difference(self.gene_rows.index)
+            if missing:
+                raise KeyError(f"Genes not in atlas: {sorted(missing)[:5]}")
+            rows = self.gene_rows.loc[genes].to_numpy()
+        cols = columns["column"].to_numpy()
+
+        #Few genes: rows of the gene-major file; otherwise whole sample blocks from counts.bin
+        #(vst.bin is only stored sample-major)
+        if values == "vst":
+            matrix = self.vst[cols][:, rows].T
+        elif len(rows) * len(self.samples) <= len(cols) * len(self.genes):
+            matrix = self.gene_major(rows, cols)
+        else:
+            matrix = self.by_sample[cols][:, rows].T
+        if values == "normalized":
+            matrix = matrix / self.size_factors[cols]
+        return pd.DataFrame(matrix, index=self.genes[rows], columns=columns.index)
+
+    #Counts of gene rows x sample columns from the gene-major files
+    def gene_major(self, rows, cols):
+        matrix = np.zeros((len(rows), len(cols)), dtype=self.by_sample.dtype)
+        for first, block in self.gene_blocks:
+            n_genes, n_samples = block.shape
+            in_block = np.flatnonzero((cols >= first) & (cols < first + n_samples))
+            known = np.flatnonzero(rows < n_genes)
+            if len(in_block) and len(known):
+                matrix[np.ix_(known, in_block)] = block[rows[known]][:, cols[in_block] - first]
+        return matrix
+
+
+#Writing the atlas as the genes x samples TSV that combine_counts.sh produced
+def export_tsv(atlas_dir, output_file, chunk_genes=512):
+    atlas = Atlas(atlas_dir)
+    with open(output_file, "w") as out:
+        out.write("\t".join(["Gene_Symbol"] + atlas.samples.index.tolist()) + "\n")
+        for start in range(0, len(atlas.genes), chunk_genes):
+            rows = np.arange(start, min(start + chunk_genes, len(atlas.genes)))
+            block = pd.DataFrame(atlas.gene_major(rows, atlas.samples["column"].to_numpy()), index=atlas.genes[rows])
+            block.to_csv(out, sep="\t", header=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or export the combined expression atlas")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build the atlas from GSE run folders")
+    build_parser.add_argument("--root", default=".", help="Directory holding the GSE run folders")
+    build_parser.add_argument("--atlas", default="atlas", help="Atlas directory")
+    build_parser.add_argument("--append", action="store_true", help="Only add GSEs that are not in the atlas yet")
+    build_parser.add_argument("--tsv", help="Also write the combined counts as a TSV (e.g. all_gse_counts.tsv)")
+
+    index_parser = subparsers.add_parser("index", help="Merge the gene-major files of all builds into one")
+    index_parser.add_argument("--atlas", default="atlas", help="Atlas directory")
+
+    export_parser = subparsers.add_parser("export", help="Write the atlas as a genes x samples TSV")
+    export_parser.add_argument("--atlas", default="atlas", help="Atlas directory")
+    export_parser.add_argument("--output", default="all_gse_counts.tsv")
+
+    get_parser = subparsers.add_parser("get", help="Write a slice of the atlas as TSV")
+    get_parser.add_argument("--atlas", default="atlas", help="Atlas directory")
+    get_parser.add_argument("--genes", nargs="+", help="Gene symbols (default: all)")
+    get_parser.add_argument("--samples", nargs="+", help="Sample names (default: all)")
+    get_parser.add_argument("--gse", nargs="+", help="Only samples from these GSEs")
+    get_parser.add_argument("--values", choices=["counts", "normalized", "vst"], default="counts", help="normalized/vst need normalize.py")
+    get_parser.add_argument("--normalization", help="Directory of the normalize.py outputs (default: the atlas directory)")
+    get_parser.add_argument("--output", default="-", help="Output file, '-' for stdout")
+
+    args = parser.parse_args()
+    if args.command == "build":
+        build(args.root, args.atlas, append=args.append)
+        if args.tsv:
+            export_tsv(args.atlas, args.tsv)
+    elif args.command == "index":
+        index(args.atlas)
+    elif args.command == "export":
+        export_tsv(args.atlas, args.output)
+    elif args.command == "get":
+        counts = Atlas(args.atlas, normalization=args.normalization).get(genes=args.genes, samples=args.samples, gse=args.gse, values=args.values)
+        counts.to_csv(sys.stdout if args.output == "-" else args.output, sep="\t", index_label="Gene_Symbol")
+        return
+    print("Complete")
+
+
+if __name__ == "__main__":
+    main()
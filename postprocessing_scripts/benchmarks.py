@@ -0,0 +1,153 @@
+#Collecting the snakemake benchmark files of all GSE runs into one table, joined with each sample's reads and layout
+#Per-sample rules write {sample}_{rule}_benchmark.txt and per-GSE rules {rule}_benchmark.txt (featurecounts, deseq);
+#per-GSE rows get the total reads of the GSE. The summary is per rule and layout: run time, throughput
+#(reads/s), memory per million reads and cores actually used (cpu_time / s), for sizing threads/mem_mb
+import os
+import sys
+import glob
+import json
+import argparse
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+
+BENCHMARK_COLUMNS = ["s", "max_rss", "max_vms", "io_in", "io_out", "mean_load", "cpu_time"]
+COLUMNS = ["gse", "sample", "rule", "layout", "reads", "date"] + BENCHMARK_COLUMNS
+
+
+#Mean of each benchmark column over the repeats in the file (snakemake writes NA/"-" for unavailable values)
+def read_benchmark(path):
+    with open(path) as fh:
+        lines = [line.rstrip("\n").split("\t") for line in fh if line.strip()]
+    if len(lines) < 2:
+        return None
+    header = lines[0]
+    values = {}
+    for column in BENCHMARK_COLUMNS:
+        if column not in header:
+            continue
+        i = header.index(column)
+        numbers = pd.to_numeric(pd.Series([row[i] for row in lines[1:] if len(row) > i]), errors="coerce")
+        values[column] = numbers.mean()
+    return values
+
+
+#{sample: (reads before filtering, layout)} from the QC table of the checkpoint, or the fastp JSONs of older runs
+def sample_reads(gse_dir):
+    qc_table = os.path.join(gse_dir, "checkpoints", "qc_table.tsv")
+    if os.path.exists(qc_table):
+        table = pd.read_csv(qc_table, sep="\t", dtype={"sample": str})
+        if table["reads_before"].notna().all():
+            return {row.sample: (row.reads_before, row.layout) for row in table.itertuples(index=False)}
+
+    reads = {}
+    for path in glob.glob(os.path.join(gse_dir, "*_results", "*", "fastp", "*_fastp.json")):
+        sample = os.path.basename(path)[:-len("_fastp.json")]
+        try:
+            with open(path) as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            continue
+        layout = "PE" if "read2_before_filtering" in data else "SE"
+        reads[sample] = (data.get("summary", {}).get("before_filtering", {}).get("total_reads"), layout)
+    return reads
+
+
+def collect_gse(gse_dir):
+    gse = os.path.basename(os.path.normpath(gse_dir))
+    reads = sample_reads(gse_dir)
+    layouts = {layout for _, layout in reads.values()}
+    gse_layout = layouts.pop() if len(layouts) == 1 else ("mixed" if layouts else None)
+    gse_reads = sum(r for r, _ in reads.values() if r is not None and not np.isnan(r)) if reads else None
+
+    rows = []
+    for path in sorted(glob.glob(os.path.join(gse_dir, "benchmarks", "*_benchmark.txt"))):
+        name = os.path.basename(path)[:-len("_benchmark.txt")]
+        sample, _, rule = name.rpartition("_")
+        try:
+            values = read_benchmark(path)
+        except OSError as e:
+            print(f"[WARN] Could not read {path}: {e}", file=sys.stderr, flush=True)
+            continue
+        if values is None:
+            continue
+        if sample:
+            sample_total, layout = reads.get(sample, (None, None))
+        else:
+            sample_total, layout = gse_reads, gse_layout
+        row = {
+            "gse": gse,
+            "sample": sample or None,
+            "rule": rule,
+            "layout": layout,
+            "reads": sample_total,
+            "date": datetime.fromtimestamp(os.path.getmtime(path)).strftime("%Y-%m-%d"),
+        }
+        row.update(values)
+        rows.append(row)
+    return rows
+
+
+#GSE run directories under the runs root (any directory with a benchmarks/ folder)
+def find_run_dirs(root):
+    return sorted(os.path.dirname(d) for d in glob.glob(os.path.join(root, "*", "benchmarks")) if os.path.isdir(d))
+
+
+def collect(run_dirs, workers):
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for gse_rows in pool.map(collect_gse, run_dirs, chunksize=16):
+            rows.extend(gse_rows)
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+#Per rule (and layout) medians, with a p95 of memory so mem_mb can be set to cover most jobs
+def summarize(df, by=("rule", "layout")):
+    df = df.copy()
+    for column in ["reads"] + BENCHMARK_COLUMNS:
+        df[column] = pd.to_numeric(df[column], errors="coerce")
+    df["reads_per_s"] = df["reads"] / df["s"].where(df["s"] > 0)
+    df["rss_mb_per_m_reads"] = df["max_rss"] / (df["reads"] / 1e6).where(df["reads"] > 0)
+    df["cores_used"] = df["cpu_time"] / df["s"].where(df["s"] > 0)
+
+    grouped = df.groupby(list(by), dropna=False)
+    summary = pd.DataFrame({
+        "jobs": grouped.size(),
+        "median_s": grouped["s"].median(),
+        "total_h": grouped["s"].sum() / 3600,
+        "median_reads_per_s": grouped["reads_per_s"].median(),
+        "median_max_rss_mb": grouped["max_rss"].median(),
+        "p95_max_rss_mb": grouped["max_rss"].quantile(0.95),
+        "median_rss_mb_per_m_reads": grouped["rss_mb_per_m_reads"].median(),
+        "median_cores_used": grouped["cores_used"].median(),
+        "median_io_in_mb": grouped["io_in"].median(),
+        "median_io_out_mb": grouped["io_out"].median(),
+    })
+    return summary.reset_index().sort_values("total_h", ascending=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collect snakemake benchmarks of all GSE runs with per-rule throughput summaries")
+    parser.add_argument("--root", default="../pipeline/gse_runs2", help="Directory holding the GSE run folders")
+    parser.add_argument("--output", default="benchmarks.tsv", help="One row per benchmark file")
+    parser.add_argument("--summary", default="benchmark_summary.tsv", help="Per-rule summary")
+    parser.add_argument("--by-date", action="store_true", help="Also split the summary by run date (spotting regressions after a container change)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    run_dirs = find_run_dirs(args.root)
+    print(f"[INFO] {len(run_dirs)} GSE run directories under {args.root}", flush=True)
+    df = collect(run_dirs, args.workers)
+    df.to_csv(args.output, sep="\t", index=False)
+
+    by = ("rule", "layout", "date") if args.by_date else ("rule", "layout")
+    summary = summarize(df, by)
+    summary.to_csv(args.summary, sep="\t", index=False, float_format="%.2f")
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(summary.to_string(index=False, float_format=lambda v: f"{v:.1f}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from ncbi import NCBI_REQUESTS_PER_SECOND, TokenBucket, run_with_retry
+from accessions import resolve_gsms
+
+
+#Extension used for downloaded FASTQ files
+def fastq_ext(compress):
+    return ".fastq.gz" if compress else ".fastq"
+
+
+#Compressing FASTQ files in place with multithreaded gzip, returns the .gz paths
+def compress_fastqs(paths, threads):
+    if paths:
+        run_with_retry(f"pigz -f -p {threads} {' '.join(paths)}", f"pigz for {os.path.basename(paths[0])}", retries=1)
+    return [f"{p}.gz" for p in paths]
+
+
+#Paths of FASTQ files already present for a sample (for restarting runs)
+def existing_fastqs(sample_name, data_dir_absolute, compress=False, threads=1):
+    raw = [os.path.join(data_dir_absolute, f"{sample_name}_{read}.fastq") for read in (1, 2)]
+    #Uncompressed files left behind (older runs, or compression interrupted by walltime) are compressed now.
+    #pigz removes each raw file only once its .gz is complete, so a .gz next to its raw file is partial
+    left = [p for p in raw if os.path.exists(p)]
+    if compress and left:
+        for p in left:
+            if os.path.exists(f"{p}.gz"):
+                os.remove(f"{p}.gz")
+        compress_fastqs(left, threads)
+
+    fq_r1_path, fq_r2_path = [p + (".gz" if compress else "") for p in raw]
+    if not os.path.exists(fq_r1_path):
+        return []
+    return [p for p in (fq_r1_path, fq_r2_path) if os.path.exists(p)]
+
+
+#Downloading FASTQ files for one SRR and renaming them to {gsm}_{srr}_[12].fastq[.gz]
+def fetch_srr(gsm, srr, data_dir_absolute, threads, compress=False):
+    current_sample_name = f"{gsm}_{srr}"
+
+    #Avoiding redownloading files if they already exist (for restarting runs)
+    existing = existing_fastqs(current_sample_name, data_dir_absolute, compress, threads)
+    if existing:
+        print(f"FASTQ file for {srr} already exists. Skipping download.", flush=True)
+        return existing
+
+    print(f"Downloading and extracting {srr} to {current_sample_name}...", flush=True)
+
+    #Downloading fastqs using SRR ID (--force so a retry can overwrite a partial attempt)
+    fasterq_cmd = f"fasterq-dump --split-files --skip-technical --force {srr} -O {data_dir_absolute} --threads {threads}"
+    try:
+        run_with_retry(fasterq_cmd, f"fasterq-dump for {srr}")
+    except subprocess.CalledProcessError:
+        print(f"WARNING: fasterq-dump failed for {srr}. Skipping this sample.", flush=True)
+        return None
+
+    fq_base = os.path.join(data_dir_absolute, srr)
+    fq1_raw = f"{fq_base}_1.fastq"
+    fq2_raw = f"{fq_base}_2.fastq"
+    fq_se_raw = f"{fq_base}.fastq"
+
+    downloaded_fastq_paths = []
+    new_fq1 = os.path.join(data_dir_absolute, f"{current_sample_name}_1.fastq")
+    if os.path.exists(fq_se_raw):
+        os.rename(fq_se_raw, new_fq1)
+        downloaded_fastq_paths.append(new_fq1)
+    elif os.path.exists(fq1_raw):
+        os.rename(fq1_raw, new_fq1)
+        downloaded_fastq_paths.append(new_fq1)
+
+        if os.path.exists(fq2_raw):
+            new_fq2 = os.path.join(data_dir_absolute, f"{current_sample_name}_2.fastq")
+            os.rename(fq2_raw, new_fq2)
+            downloaded_fastq_paths.append(new_fq2)
+    else:
+        print(f"WARNING: No expected FASTQ files found for {srr} after fasterq-dump.", flush=True)
+        return None
+
+    if compress:
+        try:
+            downloaded_fastq_paths = compress_fastqs(downloaded_fastq_paths, threads)
+        except subprocess.CalledProcessError:
+            print(f"WARNING: Compressing FASTQ files failed for {srr}. Skipping this sample.", flush=True)
+            return None
+
+    return downloaded_fastq_paths
+
+
+#Concurrent download stage: GSM lookups share one NCBI rate limiter and fasterq-dump runs
+#in a bounded worker pool, so several SRRs (and the next GSE) download at the same time
+class Downloader:
+    def __init__(self, dump_workers=4, dump_threads=4, requests_per_second=NCBI_REQUESTS_PER_SECOND, cache=None, compress=False):
+        self.limiter = TokenBucket(requests_per_second)
+        self.dump_threads = dump_threads
+        self.compress = compress
+        self.cache = cache
+        self.dump_pool = ThreadPoolExecutor(max_workers=dump_workers)
+        #GSE-level coordinators only wait on the pool above
+        self.gse_pool = ThreadPoolExecutor(max_workers=2)
+
+    def fetch_run(self, gsm, srr, data_dir_absolute):
+        paths = fetch_srr(gsm, srr, data_dir_absolute, self.dump_threads, self.compress)
+        if paths is not None and self.cache is not None:
+            self.cache.set_fastq_bytes(gsm, srr, sum(os.path.getsize(p) for p in paths))
+        return paths
+
+    #Downloading every GSM of one experiment, returns [(gsm, sample_names, fastq_paths)] in input order
+    def download_gse(self, gsms, data_dir_absolute):
+        os.makedirs(data_dir_absolute, exist_ok=True)
+        runs_by_gsm = resolve_gsms(gsms, self.cache, self.limiter)
+
+        dump_futures = []
+        for gsm in gsms:
+            dump_futures.append([
+                (run["srr"], self.dump_pool.submit(self.fetch_run, gsm, run["srr"], data_dir_absolute))
+                for run in runs_by_gsm.get(gsm, [])
+            ])
+
+        results = []
+        for gsm, futures in zip(gsms, dump_futures):
+            sample_names = []
+            fastq_paths = []
+            for srr, future in futures:
+                paths = future.result()
+                if paths is None:
+                    continue
+                sample_names.append(f"{gsm}_{srr}")
+                fastq_paths.extend(paths)
+            results.append((gsm, sample_names, fastq_paths))
+        return results
+
+    #Starting an experiment download in the background (used to prefetch the next GSE)
+    def submit_gse(self, gsms, data_dir_absolute):
+        return self.gse_pool.submit(self.download_gse, list(gsms), data_dir_absolute)
+
+    def shutdown(self):
+        self.gse_pool.shutdown(wait=True)
+        self.dump_pool.shutdown(wait=True)
@@ -0,0 +1,163 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+from contextlib import contextmanager
+import pandas as pd
+
+#Durable record of where every GSE is in process.py (downloading -> downloaded -> running -> done, or failed
+#with a reason), shared by all partitions of a run. Every change is one SQLite transaction, so a job killed at
+#walltime leaves the last state it reached; restarted jobs skip done GSEs without touching snakemake and
+#retry the failed ones. The events table keeps the history of every GSE.
+#   python ledger.py status                 -> GSEs per state for each partition
+#   python ledger.py status --failed        -> failed GSEs with their reasons
+#   python ledger.py mark done GSE1 GSE2    -> setting states by hand (e.g. from finished_null.txt)
+
+STATES = ["downloading", "downloaded", "running", "done", "failed"]
+#In-progress GSEs not updated for this long belong to a job that was killed
+STALE_HOURS = 48
+
+
+class Ledger:
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS gses ("
+                "gse TEXT PRIMARY KEY, state TEXT NOT NULL, reason TEXT, partition TEXT, "
+                "attempts INTEGER NOT NULL DEFAULT 0, updated_at REAL)"
+            )
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "gse TEXT NOT NULL, state TEXT NOT NULL, reason TEXT, partition TEXT, at REAL)"
+            )
+
+    #Fresh connection per call, like the accession cache, so concurrent slurm jobs can share the file
+    @contextmanager
+    def connect(self):
+        con = sqlite3.connect(self.path, timeout=60)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    #Moving GSEs to a state (attempts count the times processing of a GSE was started, i.e. its downloads,
+    #so GSEs failing before snakemake are capped by --max-attempts as well)
+    def set_state(self, gses, state, reason=None, partition=None):
+        if state not in STATES:
+            raise ValueError(f"Unknown state {state}, expected one of {STATES}")
+        gses = [gses] if isinstance(gses, str) else list(gses)
+        now = time.time()
+        with self.connect() as con:
+            for gse in gses:
+                con.execute(
+                    "INSERT INTO gses (gse, state, reason, partition, attempts, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(gse) DO UPDATE SET state = excluded.state, reason = excluded.reason, "
+                    "partition = COALESCE(excluded.partition, gses.partition), "
+                    "attempts = gses.attempts + excluded.attempts, updated_at = excluded.updated_at",
+                    (gse, state, reason, partition, 1 if state == "downloading" else 0, now),
+                )
+                con.execute(
+                    "INSERT INTO events (gse, state, reason, partition, at) VALUES (?, ?, ?, ?, ?)",
+                    (gse, state, reason, partition, now),
+                )
+
+    #{gse: {state, reason, partition, attempts, updated_at}} for the given GSEs (all when None)
+    def states(self, gses=None):
+        columns = ["gse", "state", "reason", "partition", "attempts", "updated_at"]
+        found = {}
+        with self.connect() as con:
+            if gses is None:
+                rows = con.execute(f"SELECT {', '.join(columns)} FROM gses").fetchall()
+            else:
+                gses = list(gses)
+                rows = []
+                for start in range(0, len(gses), 500):
+                    batch = gses[start:start + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    rows.extend(con.execute(f"SELECT {', '.join(columns)} FROM gses WHERE gse IN ({placeholders})", batch))
+        for row in rows:
+            found[row[0]] = dict(zip(columns[1:], row[1:]))
+        return found
+
+    def table(self):
+        with self.connect() as con:
+            return pd.read_sql_query("SELECT * FROM gses ORDER BY gse", con)
+
+    def history(self, gse):
+        with self.connect() as con:
+            return pd.read_sql_query("SELECT * FROM events WHERE gse = ? ORDER BY at", con, params=(gse,))
+
+
+#Default ledger location, next to the accession cache
+def default_ledger_path():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "ledger.sqlite")
+
+
+def print_status(ledger, failed=False, stale_hours=None):
+    table = ledger.table()
+    if table.empty:
+        print("Ledger is empty")
+        return
+    table["partition"] = table["partition"].fillna("-")
+    counts = table.pivot_table(index="partition", columns="state", values="gse", aggfunc="count", fill_value=0)
+    counts = counts.reindex(columns=[s for s in STATES if s in counts.columns])
+    counts.loc["total"] = counts.sum()
+    print(counts.to_string())
+
+    #GSEs still marked as in progress long after their last update belong to jobs that were killed
+    if stale_hours is not None:
+        stale = table[table["state"].isin(["downloading", "downloaded", "running"])
+                      & (time.time() - table["updated_at"] > stale_hours * 3600)]
+        if len(stale):
+            print(f"\n{len(stale)} GSEs not updated for more than {stale_hours}h (job probably killed):")
+            print(stale[["gse", "state", "partition", "attempts"]].to_string(index=False))
+
+    if failed:
+        failures = table[table["state"] == "failed"]
+        if len(failures):
+            print("\nFailed GSEs:")
+            print(failures[["gse", "partition", "attempts", "reason"]].to_string(index=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-GSE processing ledger shared by all partitions")
+    parser.add_argument("--ledger", default=default_ledger_path(), help="Ledger database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    status_parser = subparsers.add_parser("status", help="GSEs per state and partition")
+    status_parser.add_argument("--failed", action="store_true", help="List failed GSEs with their reasons")
+    status_parser.add_argument("--stale-hours", type=float, default=STALE_HOURS, help="Report in-progress GSEs not updated for this long")
+
+    mark_parser = subparsers.add_parser("mark", help="Set the state of GSEs by hand")
+    mark_parser.add_argument("state", choices=STATES)
+    mark_parser.add_argument("gses", nargs="*", help="GSE accessions")
+    mark_parser.add_argument("--from-file", help="File with one GSE per line (e.g. finished_null.txt)")
+    mark_parser.add_argument("--reason")
+
+    history_parser = subparsers.add_parser("history", help="State changes of one GSE")
+    history_parser.add_argument("gse")
+
+    args = parser.parse_args()
+    ledger = Ledger(args.ledger)
+    if args.command == "status":
+        print_status(ledger, failed=args.failed, stale_hours=args.stale_hours)
+    elif args.command == "mark":
+        gses = [g.strip().upper() for g in args.gses]
+        if args.from_file:
+            with open(args.from_file) as fh:
+                gses.extend(line.strip().upper() for line in fh if line.strip())
+        if not gses:
+            sys.exit("No GSEs given")
+        ledger.set_state(gses, args.state, reason=args.reason or "set by hand")
+        print(f"Marked {len(gses)} GSEs as {args.state}")
+    elif args.command == "history":
+        history = ledger.history(args.gse.upper())
+        history["at"] = pd.to_datetime(history["at"], unit="s").dt.strftime("%Y-%m-%d %H:%M:%S")
+        print(history.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import os
+import random
+import subprocess
+import threading
+import time
+
+
+#NCBI allows 3 E-utility requests per second without an API key and 10 with one
+NCBI_REQUESTS_PER_SECOND = 10 if os.environ.get("NCBI_API_KEY") else 3
+
+
+#Token bucket shared by every thread that talks to NCBI, one token per HTTP request
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    #Taking tokens for n requests; more than the capacity at once leaves the bucket in debt, so later
+    #callers wait until those requests are paid for
+    def acquire(self, n=1):
+        needed = min(n, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= needed:
+                    self.tokens -= n
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+#Running a shell command, retrying with exponential backoff (plus jitter) on failure
+#(requests is the number of NCBI requests the command makes, charged to limiter on every attempt)
+def run_with_retry(cmd, label, limiter=None, requests=1, retries=4, base_delay=5, **kwargs):
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire(requests)
+        try:
+            return subprocess.run(cmd, shell=True, check=True, **kwargs)
+        except subprocess.CalledProcessError as e:
+            if attempt == retries:
+                raise
+            delay = base_delay * (2 ** attempt) + random.uniform(0, base_delay)
+            print(
+                f"[WARN] {label} failed with exit code {e.returncode} "
+                f"(attempt {attempt + 1}/{retries + 1}), retrying in {delay:.0f} seconds",
+                flush=True,
+            )
+            time.sleep(delay)
@@ -0,0 +1,263 @@
+#Atlas-wide normalization and PCA over the combined counts (counts.bin of atlas.py), out of core
+#Every step reads counts.bin (or vst.bin) one block of samples at a time, so memory is bounded by the block size
+#and per-gene vectors, never the whole matrix:
+#   1. size factors: DESeq2 median-of-ratios with the "poscounts" geometric means (zeros are common across
+#      thousands of samples, so the plain geometric mean would drop almost every gene)
+#   2. variance-stabilizing transform: DESeq2's closed form for the parametric dispersion fit
+#      disp = asymptDisp + extraPois / mean, fitted on the per-gene moments of the normalized counts
+#   3. PCA of the VST on the most variable genes, randomized SVD (range finder + power iterations) where each
+#      product with the matrix is a pass over the sample blocks
+#Results are written next to the atlas (or to --output, read with Atlas(..., normalization=) / get --normalization):
+#   size_factors.tsv, vst.bin (float32, samples x genes), normalization.json,
+#   pca_coordinates.tsv, pca_variance.tsv, pca_loadings.tsv
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from atlas import load_store, store_fingerprint
+
+
+VST_DTYPE = np.float32
+
+
+def sample_blocks(n_samples, chunk_samples):
+    for start in range(0, n_samples, chunk_samples):
+        yield start, min(start + chunk_samples, n_samples)
+
+
+#Log geometric mean of every gene over all samples, zeros counted as 1 (poscounts)
+def log_geo_means(counts, chunk_samples):
+    n_samples, n_genes = counts.shape
+    log_sums = np.zeros(n_genes)
+    for start, end in sample_blocks(n_samples, chunk_samples):
+        block = counts[start:end]
+        log_sums += np.log(np.where(block > 0, block, 1)).sum(axis=0)
+    return log_sums / n_samples
+
+
+#Median of count / geometric mean over the genes a sample expresses, rescaled to a geometric mean of 1
+def size_factors(counts, log_geo, chunk_samples):
+    n_samples = counts.shape[0]
+    factors = np.full(n_samples, np.nan)
+    for start, end in sample_blocks(n_samples, chunk_samples):
+        block = counts[start:end].astype(np.float64)
+        ratios = np.where(block > 0, np.log(np.where(block > 0, block, 1)) - log_geo, np.nan)
+        with np.errstate(all="ignore"):
+            factors[start:end] = np.exp(np.nanmedian(ratios, axis=1))
+    empty = ~np.isfinite(factors)
+    if empty.any():
+        print(f"[WARN] {int(empty.sum())} samples share no genes with the atlas, their size factor is set to 1", flush=True)
+        factors[empty] = 1.0
+    return factors / np.exp(np.log(factors).mean())
+
+
+#Per-gene mean and variance of the normalized counts
+def normalized_moments(counts, factors, chunk_samples):
+    n_samples, n_genes = counts.shape
+    sums = np.zeros(n_genes)
+    squares = np.zeros(n_genes)
+    for start, end in sample_blocks(n_samples, chunk_samples):
+        block = counts[start:end] / factors[start:end, None]
+        sums += block.sum(axis=0)
+        squares += (block ** 2).sum(axis=0)
+    mean = sums / n_samples
+    var = (squares - n_samples * mean ** 2) / max(n_samples - 1, 1)
+    return mean, np.maximum(var, 0)
+
+
+#disp = asymptDisp + extraPois / mean, fitted on the method-of-moments dispersions with the outlier trimming
+#DESeq2 uses for its parametric fit (genes with residual ratios outside 1e-4..15 are dropped and it is refitted)
+#A negative extraPois is refitted as a constant dispersion. When asymptDisp comes out at or near zero (little
+#spread in the gene means, or near-Poisson counts, so the two terms cannot be told apart), every gene gets the
+#mean dispersion instead, like DESeq2's fitType="mean" fallback; clipping asymptDisp to ~0 would make the VST
+#a constant
+def fit_dispersion(mean, var, iterations=10):
+    with np.errstate(all="ignore"):
+        disp = (var - mean) / mean ** 2
+    usable = (mean > 1) & np.isfinite(disp) & (disp > 1e-7)
+    if usable.sum() < 2:
+        raise ValueError("Fewer than 2 genes with a mean above 1 and overdispersed counts, the VST cannot be fitted")
+    use = usable
+    coefs = None
+    for _ in range(iterations):
+        design = np.column_stack([np.ones(use.sum()), 1 / mean[use]])
+        new_coefs, *_ = np.linalg.lstsq(design, disp[use], rcond=None)
+        if new_coefs[0] <= 0 or new_coefs[1] < 0:
+            coefs = new_coefs
+            break
+        fitted = new_coefs[0] + new_coefs[1] / mean
+        with np.errstate(all="ignore"):
+            ratio = disp / fitted
+        converged = coefs is not None and np.allclose(new_coefs, coefs, rtol=1e-6)
+        coefs = new_coefs
+        use = use & (ratio > 1e-4) & (ratio < 15)
+        if converged or use.sum() < 2:
+            break
+
+    #No 1/mean term in the data (extraPois < 0): a constant dispersion fits
+    if coefs[0] > 0 and coefs[1] < 0:
+        return float(disp[use].mean()), 0.0
+    if coefs[0] <= 0 or vst_spread(mean, coefs[0], coefs[1]) is not None:
+        mean_disp = float(disp[usable].mean())
+        print(
+            f"[WARN] Parametric dispersion fit failed ({coefs[0]:.3g} + {coefs[1]:.3g} / mean), "
+            f"using the mean dispersion {mean_disp:.4g} for every gene", flush=True,
+        )
+        return mean_disp, 0.0
+    return float(coefs[0]), float(coefs[1])
+
+
+#None when the VST separates low from high expressed genes (5th and 95th percentile of the gene means) by
+#at least a tenth of their log2 ratio, otherwise (low, high, spread) of a transform that is close to flat
+def vst_spread(mean, asympt_disp, extra_pois, min_fraction=0.1):
+    expressed = mean[mean > 0]
+    low, high = np.percentile(expressed, [5, 95])
+    with np.errstate(all="ignore"):
+        spread = float(np.diff(vst(np.array([low, high]), asympt_disp, extra_pois))[0])
+    if spread >= min_fraction * np.log2((high + 1) / (low + 1)):
+        return None
+    return low, high, spread
+
+
+def vst(normalized, asympt_disp, extra_pois):
+    return np.log2(
+        (1 + extra_pois + 2 * asympt_disp * normalized
+         + 2 * np.sqrt(asympt_disp * normalized * (1 + extra_pois + asympt_disp * normalized)))
+        / (4 * asympt_disp)
+    )
+
+
+#VST of every sample written to vst.bin, with the per-gene mean and variance of the VST for picking PCA genes
+def write_vst(counts, factors, asympt_disp, extra_pois, path, chunk_samples):
+    n_samples, n_genes = counts.shape
+    tmp_path = f"{path}.tmp"
+    out = np.memmap(tmp_path, dtype=VST_DTYPE, mode="w+", shape=counts.shape)
+    sums = np.zeros(n_genes)
+    squares = np.zeros(n_genes)
+    for start, end in sample_blocks(n_samples, chunk_samples):
+        block = vst(counts[start:end] / factors[start:end, None], asympt_disp, extra_pois)
+        out[start:end] = block
+        sums += block.sum(axis=0)
+        squares += (block ** 2).sum(axis=0)
+    out.flush()
+    del out
+    os.replace(tmp_path, path)
+    mean = sums / n_samples
+    return mean, np.maximum((squares - n_samples * mean ** 2) / max(n_samples - 1, 1), 0)
+
+
+#Randomized PCA of the centered columns `genes` of a samples x genes memmap, streamed over sample blocks
+def randomized_pca(matrix, genes, center, n_components, chunk_samples, oversample=10, power_iterations=4, seed=0):
+    n_samples = matrix.shape[0]
+    rank = min(n_components + oversample, len(genes), n_samples)
+    rng = np.random.default_rng(seed)
+
+    def block(start, end):
+        return matrix[start:end][:, genes].astype(np.float64) - center
+
+    #X @ M and X.T @ M, one pass each
+    def times(m):
+        return np.vstack([block(start, end) @ m for start, end in sample_blocks(n_samples, chunk_samples)])
+
+    def transposed_times(m):
+        product = np.zeros((len(genes), m.shape[1]))
+        for start, end in sample_blocks(n_samples, chunk_samples):
+            product += block(start, end).T @ m[start:end]
+        return product
+
+    q, _ = np.linalg.qr(times(rng.standard_normal((len(genes), rank))))
+    for _ in range(power_iterations):
+        z, _ = np.linalg.qr(transposed_times(q))
+        q, _ = np.linalg.qr(times(z))
+    b = transposed_times(q).T
+    u, s, vt = np.linalg.svd(b, full_matrices=False)
+    n_components = min(n_components, len(s))
+    scores = q @ u[:, :n_components] * s[:n_components]
+    variance = s[:n_components] ** 2 / max(n_samples - 1, 1)
+    return scores, variance, vt[:n_components]
+
+
+def normalize(atlas_dir, output_dir=None, n_components=20, pca_genes=2000, chunk_samples=1024, seed=0):
+    output_dir = output_dir or atlas_dir
+    os.makedirs(output_dir, exist_ok=True)
+    meta, genes, samples = load_store(atlas_dir)
+    counts = np.memmap(
+        os.path.join(atlas_dir, "counts.bin"), dtype=meta["dtype"], mode="r",
+        shape=(meta["n_samples"], meta["n_genes"]),
+    )
+    fingerprint = store_fingerprint(atlas_dir, samples)
+    print(f"[INFO] Normalizing {meta['n_genes']} genes x {meta['n_samples']} samples", flush=True)
+
+    log_geo = log_geo_means(counts, chunk_samples)
+    factors = size_factors(counts, log_geo, chunk_samples)
+    pd.DataFrame({"sample": samples["sample"], "gse": samples["gse"], "size_factor": factors}).to_csv(
+        os.path.join(output_dir, "size_factors.tsv"), sep="\t", index=False, float_format="%.6g",
+    )
+
+    mean, var = normalized_moments(counts, factors, chunk_samples)
+    asympt_disp, extra_pois = fit_dispersion(mean, var)
+    print(f"[INFO] Dispersion fit: {asympt_disp:.4g} + {extra_pois:.4g} / mean", flush=True)
+    flat = vst_spread(mean, asympt_disp, extra_pois)
+    if flat is not None:
+        raise ValueError(
+            f"VST is flat: genes with mean {flat[0]:.3g} and {flat[1]:.3g} differ by {flat[2]:.3g} log2 units, "
+            f"vst.bin is not written"
+        )
+    vst_mean, vst_var = write_vst(counts, factors, asympt_disp, extra_pois, os.path.join(output_dir, "vst.bin"), chunk_samples)
+
+    #PCA on the most variable genes of the VST (DESeq2's plotPCA uses the top 500 of one experiment)
+    top = np.sort(np.argsort(vst_var)[::-1][:min(pca_genes, len(genes))])
+    vst_matrix = np.memmap(os.path.join(output_dir, "vst.bin"), dtype=VST_DTYPE, mode="r", shape=counts.shape)
+    scores, variance, loadings = randomized_pca(vst_matrix, top, vst_mean[top], n_components, chunk_samples, seed=seed)
+    components = [f"PC{i + 1}" for i in range(len(variance))]
+
+    coordinates = pd.DataFrame(scores, columns=components)
+    coordinates.insert(0, "gse", samples["gse"].to_numpy())
+    coordinates.insert(0, "sample", samples["sample"].to_numpy())
+    coordinates.to_csv(os.path.join(output_dir, "pca_coordinates.tsv"), sep="\t", index=False, float_format="%.6g")
+    pd.DataFrame({
+        "component": components,
+        "variance": variance,
+        "fraction": variance / vst_var[top].sum(),
+    }).to_csv(os.path.join(output_dir, "pca_variance.tsv"), sep="\t", index=False, float_format="%.6g")
+    pd.DataFrame(loadings.T, index=genes[top], columns=components).to_csv(
+        os.path.join(output_dir, "pca_loadings.tsv"), sep="\t", index_label="gene", float_format="%.6g",
+    )
+
+    #Written last, the Atlas class only uses outputs whose fingerprint matches the current counts
+    normalization = {
+        "fingerprint": fingerprint,
+        "n_genes": meta["n_genes"],
+        "n_samples": meta["n_samples"],
+        "size_factors": "median-of-ratios (poscounts)",
+        "asympt_disp": asympt_disp,
+        "extra_pois": extra_pois,
+        "vst_dtype": np.dtype(VST_DTYPE).name,
+        "pca_genes": int(len(top)),
+        "pca_components": len(components),
+    }
+    tmp = os.path.join(output_dir, "normalization.json.tmp")
+    with open(tmp, "w") as fh:
+        json.dump(normalization, fh, indent=2)
+    os.replace(tmp, os.path.join(output_dir, "normalization.json"))
+    explained = ", ".join(f"{c} {f:.1%}" for c, f in zip(components[:3], variance[:3] / vst_var[top].sum()))
+    print(f"[INFO] PCA on {len(top)} genes: {explained}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Atlas-wide size factors, variance-stabilized counts and PCA")
+    parser.add_argument("--atlas", default="atlas", help="Atlas directory (atlas.py build)")
+    parser.add_argument("--output", help="Output directory (default: the atlas directory)")
+    parser.add_argument("--components", type=int, default=20, help="Number of principal components")
+    parser.add_argument("--pca-genes", type=int, default=2000, help="Most variable genes used for the PCA")
+    parser.add_argument("--chunk-samples", type=int, default=1024, help="Samples read per block (bounds memory)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    normalize(args.atlas, args.output, args.components, args.pca_genes, args.chunk_samples, args.seed)
+    print("Complete")
+
+
+if __name__ == "__main__":
+    main()
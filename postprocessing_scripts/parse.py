@@ -1,31 +1,166 @@
-import pandas as pd
+import os
+import glob
 import math
+import heapq
+import argparse
+import pandas as pd
+from accessions import AccessionCache, default_cache_path, resolve_gsms
+from allocation import allocated_resources
+from ncbi import NCBI_REQUESTS_PER_SECOND, TokenBucket
+
+#Splitting labeled.txt into parts for separate slurm jobs, balanced on the estimated work per GSE
+#Cost of a GSE (in core-seconds) comes from, in order of preference:
+#   1. benchmarks/*_benchmark.txt of a previous run of that GSE
+#   2. SRA run metadata (bases, scaled by a rate fitted on benchmarked GSEs), from the accession cache and
+#      resolved from NCBI for GSMs not cached yet (--no-resolve to only use the cache)
+#   3. the median cost per sample of the GSEs estimated above
+#GSEs are then packed longest-first onto the least loaded part (LPT)
+
+#Rates used when there are no benchmarked GSEs to fit them from (all costs are core-seconds, giraffe at
+#~1-2k reads/s per thread dominates the per-gigabase rate)
+DEFAULT_SECONDS_PER_GBASE = 7200
+#Paired-end runs go through the PE rules (two FASTQs through fastp/centrifuge, paired giraffe)
+PAIRED_FACTOR = 1.2
+#Per-sample rules that do not scale with depth, plus the per-GSE featureCounts/DESeq2/MultiQC tail
+SAMPLE_OVERHEAD_SECONDS = 120
+GSE_OVERHEAD_SECONDS = 900
+
+
+#Core-seconds of a previous run from the snakemake benchmark files: cpu_time of every job, or the wall time
+#scaled by the job's mean CPU load when cpu_time is missing (a 12-thread job busy for s seconds uses ~12 * s)
+def benchmark_seconds(gse_dir):
+    total = 0.0
+    for path in glob.glob(os.path.join(gse_dir, "benchmarks", "*_benchmark.txt")):
+        try:
+            bench = pd.read_csv(path, sep="\t", na_values=["NA", "-"])
+        except (OSError, ValueError, pd.errors.EmptyDataError):
+            continue
+        cpu_time = bench["cpu_time"].mean() if "cpu_time" in bench else float("nan")
+        if pd.isna(cpu_time) and "s" in bench:
+            load = bench["mean_load"].mean() / 100 if "mean_load" in bench else float("nan")
+            cpu_time = bench["s"].mean() * (max(load, 1.0) if pd.notna(load) else 1.0)
+        if pd.notna(cpu_time):
+            total += cpu_time
+    return total
+
+
+#Sequencing volume of a GSE from the accession cache, in gigabases with paired-end runs weighted up
+def run_gbases(gsms, runs_by_gsm):
+    gbases = 0.0
+    for gsm in gsms:
+        runs = runs_by_gsm.get(gsm)
+        if not runs or any(run["bases"] is None for run in runs):
+            return None
+        for run in runs:
+            gbases += run["bases"] / 1e9 * (PAIRED_FACTOR if run["layout"] == "PE" else 1.0)
+    return gbases
+
+
+def estimate_costs(df, runs_root, cache):
+    gses = {gse: group["gsm"].tolist() for gse, group in df.groupby("gse", sort=False)}
+    runs_by_gsm = cache.lookup(df["gsm"].unique()) if cache is not None else {}
+
+    estimates = pd.DataFrame(index=list(gses))
+    estimates["samples"] = [len(gsms) for gsms in gses.values()]
+    estimates["gbases"] = [run_gbases(gsms, runs_by_gsm) for gsms in gses.values()]
+    estimates["benchmark"] = [benchmark_seconds(os.path.join(runs_root, gse)) if runs_root else 0.0 for gse in gses]
+    estimates["gbases"] = estimates["gbases"].astype(float)
+
+    #Fitting seconds per gigabase on GSEs that have both a benchmark and run metadata
+    fit = estimates[(estimates["benchmark"] > 0) & estimates["gbases"].notna() & (estimates["gbases"] > 0)]
+    if len(fit):
+        variable = fit["benchmark"] - SAMPLE_OVERHEAD_SECONDS * fit["samples"] - GSE_OVERHEAD_SECONDS
+        seconds_per_gbase = max(variable.sum() / fit["gbases"].sum(), 1.0)
+        print(f"[INFO] Fitted {seconds_per_gbase:.0f} s/Gbase from {len(fit)} benchmarked GSEs", flush=True)
+    else:
+        seconds_per_gbase = DEFAULT_SECONDS_PER_GBASE
+
+    modelled = GSE_OVERHEAD_SECONDS + SAMPLE_OVERHEAD_SECONDS * estimates["samples"] + seconds_per_gbase * estimates["gbases"]
+    estimates["cost"] = estimates["benchmark"].where(estimates["benchmark"] > 0, modelled)
+    estimates["source"] = "benchmark"
+    estimates.loc[estimates["benchmark"] <= 0, "source"] = "metadata"
+
+    #Anything left falls back on the typical cost per sample
+    unknown = estimates["cost"].isna()
+    if unknown.any():
+        known = estimates[~unknown]
+        if len(known):
+            per_sample = (known["cost"] / known["samples"]).median()
+        else:
+            per_sample = SAMPLE_OVERHEAD_SECONDS + DEFAULT_SECONDS_PER_GBASE
+        estimates.loc[unknown, "cost"] = GSE_OVERHEAD_SECONDS + per_sample * estimates.loc[unknown, "samples"]
+        estimates.loc[unknown, "source"] = "samples"
+        print(f"[WARN] {unknown.sum()} GSEs have no benchmark or run metadata, estimated from sample counts", flush=True)
+    return estimates
+
+
+#Longest processing time first: each GSE goes to the part with the least work so far
+def pack(costs, n_parts):
+    heap = [(0.0, i) for i in range(n_parts)]
+    parts = [[] for _ in range(n_parts)]
+    for gse, cost in sorted(costs.items(), key=lambda x: -x[1]):
+        load, i = heapq.heappop(heap)
+        parts[i].append(gse)
+        heapq.heappush(heap, (load + cost, i))
+    loads = [sum(costs[gse] for gse in part) for part in parts]
+    return parts, loads
+
 
-input_file = "labeled.txt"
-output_prefix = "labeled"
-n_parts = 10
+def main():
+    parser = argparse.ArgumentParser(description="Split labeled.txt into parts with balanced estimated work")
+    parser.add_argument("--input", default="labeled.txt")
+    parser.add_argument("--output-prefix", default="labeled")
+    parser.add_argument("--parts", type=int, default=10, help="Number of parts (minimum when --walltime is given)")
+    parser.add_argument("--walltime", type=float, help="Per-part walltime budget in hours, adds parts until every part fits")
+    parser.add_argument("--cores", type=int, help="Cores of each process.py job, converts core-seconds to walltime (default: as process.py, the slurm allocation or all cores)")
+    parser.add_argument("--runs-root", default="../pipeline/gse_runs2", help="Previous run folders with benchmarks/")
+    parser.add_argument("--accession-cache", default=default_cache_path(), help="SQLite cache of resolved GSM -> SRR runs")
+    parser.add_argument("--no-resolve", dest="resolve", action="store_false", help="Only use run metadata already in the accession cache (no NCBI queries)")
+    args = parser.parse_args()
 
-#Get data
-df = pd.read_csv(input_file, sep="\t", dtype=str)
-df['gse'] = df['gse'].str.strip()
+    #Get data
+    df = pd.read_csv(args.input, sep="\t", dtype=str)
+    df["gse"] = df["gse"].str.strip()
+    df["gsm"] = df["gsm"].str.strip()
 
-#Sort by experiment ID
-groups = [(gse, group_df) for gse, group_df in df.groupby('gse', sort=False)]
+    #GSMs missing from the cache are resolved from NCBI (only those are queried), which fills the cache for
+    #process.py as well
+    if args.resolve:
+        cache = AccessionCache(args.accession_cache)
+        resolve_gsms(df["gsm"].unique(), cache, TokenBucket(NCBI_REQUESTS_PER_SECOND))
+    else:
+        cache = AccessionCache(args.accession_cache) if os.path.exists(args.accession_cache) else None
+    estimates = estimate_costs(df, args.runs_root if os.path.isdir(args.runs_root) else None, cache)
+    print(estimates["source"].value_counts().to_string(), flush=True)
 
-#Sort groups with smallest first
-groups.sort(key=lambda x: len(x[1]))
+    #Hours of walltime per part
+    cores = args.cores or allocated_resources()[0]
+    print(f"[INFO] Walltime estimated for {cores} cores per job", flush=True)
+    costs = (estimates["cost"] / cores / 3600).to_dict()
+    n_parts = min(args.parts, len(costs))
+    parts, loads = pack(costs, n_parts)
+    if args.walltime:
+        largest = max(costs.values())
+        if largest > args.walltime:
+            print(f"[WARN] Largest GSE is estimated at {largest:.1f} h, over the {args.walltime} h budget", flush=True)
+        n_parts = min(max(n_parts, math.ceil(sum(costs.values()) / args.walltime)), len(costs))
+        while n_parts < len(costs):
+            parts, loads = pack(costs, n_parts)
+            if max(loads) <= max(args.walltime, largest):
+                break
+            n_parts += 1
+        else:
+            parts, loads = pack(costs, n_parts)
 
-#Round robin assignment
-parts = [[] for _ in range(n_parts)]
-for idx, group in enumerate(groups):
-    part_index = idx % n_parts
-    parts[part_index].append(group)
+    #One file per part with shorter experiments first
+    groups = dict(list(df.groupby("gse", sort=False)))
+    for i, (part, load) in enumerate(zip(parts, loads), start=1):
+        part_sorted = sorted(part, key=lambda gse: costs[gse])
+        part_df = pd.concat([groups[gse] for gse in part_sorted])
+        output_file = f"{args.output_prefix}{i:02d}"
+        part_df.to_csv(output_file, sep="\t", index=False)
+        print(f"Wrote {len(part_df)} rows ({len(part)} GSEs, ~{load:.1f} h) to {output_file}")
 
-#Break into 10 smaller files with shorter experiments first
-for i, part_groups in enumerate(parts, start=1):
-    part_groups_sorted = sorted(part_groups, key=lambda x: len(x[1]))
-    part_df = pd.concat([gdf for _, gdf in part_groups_sorted])
-    output_file = f"{output_prefix}{i:02d}"
-    part_df.to_csv(output_file, sep="\t", index=False)
-    print(f"Wrote {len(part_df)} rows to {output_file}")
 
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,16 @@
 import os
+import argparse
 import subprocess
 import pandas as pd
-import sys
-import shutil
 import time
+from downloads import Downloader, fastq_ext
+from accessions import AccessionCache, default_cache_path
+from resources import ensure_resources
+from allocation import allocated_resources
+from ledger import Ledger, default_ledger_path, STALE_HOURS
 
 
-#GSEs to ignore on next run
+#GSEs to ignore on next run (hand-maintained list, the ledger records the ones finished by process.py)
 def get_finished_gses(file_path="../postprocessing_scripts/finished_null.txt"):
     finished_gses = set()
     if os.path.exists(file_path):
@@ -15,6 +19,20 @@ def get_finished_gses(file_path="../postprocessing_scripts/finished_null.txt"):
                 finished_gses.add(line.strip().upper())
     return finished_gses
 
+
+#Whether snakemake produced the final outputs of a GSE (run directory as laid out by run_pipeline);
+#the retention sentinel is written last, a GSE where every sample failed QC only has its QC files
+def gse_outputs_complete(gse_run_dir, gse):
+    results = os.path.join(gse_run_dir, f"{gse}_results")
+    if os.path.exists(os.path.join(results, "retention.json")):
+        return True
+    if os.path.exists(os.path.join(results, "multiqc_report.html")) and os.path.exists(os.path.join(results, "deseq2", "normalized_counts.tsv")):
+        return True
+    qc_table = os.path.join(gse_run_dir, "checkpoints", "qc_table.tsv")
+    if os.path.exists(qc_table):
+        return not (pd.read_csv(qc_table, sep="\t")["passed"].astype(str) == "True").any()
+    return False
+
 #Added wait to avoid issues with NCBI connection
 def wait_for_files_to_appear(expected_fastq_paths, timeout=300, interval=5):
     start_time = time.time()
@@ -44,111 +62,57 @@ def wait_for_files_to_appear(expected_fastq_paths, timeout=300, interval=5):
     return False
 
 
-#Downloading FASTQ files using GSM ID
-def download(gsm, data_dir_absolute):
-    #Have to get SRR value from GSM value in order to use fasterq-dump
-    cmd = f"esearch -db sra -query {gsm} | efetch -format runinfo | cut -d',' -f1 | grep SRR"
-    try:
-        srr_output = subprocess.check_output(cmd, shell=True, text=True, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        print(
-            f"ERROR: E-utility search failed for {gsm} with exit code {e.returncode}. ",
-            flush=True,
-        )
-        print(f"Stderr: {e.stderr}", flush=True)
-        return [], []
-
-    srr_ids = srr_output.strip().split("\n")
-
-    sample_names = []
-    downloaded_fastq_paths = []
-
-    for srr in srr_ids:
-        current_sample_name = f"{gsm}_{srr}"
-
-        #Avoiding redownloading files if they already exist (for restarting runs)
-        fq_se_path = os.path.join(data_dir_absolute, f"{current_sample_name}_1.fastq")
-        fq_pe_r1_path = os.path.join(data_dir_absolute, f"{current_sample_name}_1.fastq")
-        fq_pe_r2_path = os.path.join(data_dir_absolute, f"{current_sample_name}_2.fastq")
-
-        if os.path.exists(fq_se_path) or (os.path.exists(fq_pe_r1_path) and os.path.exists(fq_pe_r2_path)):
-            print(f"FASTQ file for {srr} already exists. Skipping download.", flush=True)
-            sample_names.append(current_sample_name)
-            if os.path.exists(fq_se_path):
-                downloaded_fastq_paths.append(fq_se_path)
-            if os.path.exists(fq_pe_r1_path):
-                downloaded_fastq_paths.append(fq_pe_r1_path)
-            if os.path.exists(fq_pe_r2_path):
-                downloaded_fastq_paths.append(fq_pe_r2_path)
-            continue
+#Resource directory for this job, shared with other jobs using the same directory and only restaged
+#when the source indexes change (see resources.py). Returns the staged generation and the lock file that
+#keeps it from being removed while this job runs
+def prepare_resources(resource_dir, top_level_project_root, mode="auto"):
+    return ensure_resources(os.path.join(top_level_project_root, "resources"), resource_dir, mode=mode)
 
-        print(f"Downloading and extracting {srr} to {current_sample_name}...", flush=True)
-        
-        #Downloading fastqs using SRR ID
-        fasterq_cmd = f"fasterq-dump --split-files --skip-technical {srr} -O {data_dir_absolute} --threads 10"
-        try:
-            subprocess.run(fasterq_cmd, shell=True, check=True)
-        except subprocess.CalledProcessError:
-            print(f"WARNING: fasterq-dump failed for {srr}. Skipping this sample.", flush=True)
-            continue
 
-        fq_base = os.path.join(data_dir_absolute, srr)
-        fq1_raw = f"{fq_base}_1.fastq"
-        fq2_raw = f"{fq_base}_2.fastq"
-        fq_se_raw = f"{fq_base}.fastq"
-
-        if os.path.exists(fq_se_raw):
-            new_fq1 = os.path.join(data_dir_absolute, f"{current_sample_name}_1.fastq")
-            os.rename(fq_se_raw, new_fq1)
-            downloaded_fastq_paths.append(new_fq1)
-        elif os.path.exists(fq1_raw):
-            new_fq1 = os.path.join(data_dir_absolute, f"{current_sample_name}_1.fastq")
-            os.rename(fq1_raw, new_fq1)
-            downloaded_fastq_paths.append(new_fq1)
-
-            if os.path.exists(fq2_raw):
-                new_fq2 = os.path.join(data_dir_absolute, f"{current_sample_name}_2.fastq")
-                os.rename(fq2_raw, new_fq2)
-                downloaded_fastq_paths.append(new_fq2)
-        else:
-            print(f"WARNING: No expected FASTQ files found for {srr} after fasterq-dump.", flush=True)
-            continue
-
-        sample_names.append(current_sample_name)
+#Path of a host file inside the container (project root is bound to /mnt/project_root)
+def container_path(host_path, top_level_project_root):
+    return os.path.join("/mnt/project_root", os.path.relpath(host_path, top_level_project_root))
 
-        #Adding a pause for rate limits
-        print("Pausing for 5 seconds", flush=True)
-        time.sleep(5)
 
-    return sample_names, downloaded_fastq_paths
+#Creating the samples section of a config file using conditions from metadata
+#(indent is added for the experiments: layout of batch runs)
+def sample_entries_text(gsm_srr_to_char_map, data_dir_absolute, top_level_project_root, compress, indent=""):
+    #Used for labeling the conditions of samples for DEseq2 in config file
+    unique_characteristics = sorted(list(set(gsm_srr_to_char_map.values())))
+    char_to_condition_name = {char: f"group{i+1}" for i, char in enumerate(unique_characteristics)}
+    sample_entries = []
+    for sample_name, char_val in gsm_srr_to_char_map.items():
+        condition_name = char_to_condition_name[char_val]
+        entry = f"{indent}  {sample_name}:\n"
 
-#Used to make temporary directories for resources as we are running many slurm jobs at once
-def prepare_resources(resource_dir, top_level_project_root):
-    #Skipping if already exists
-    if os.path.exists(resource_dir):
-        print(f"[INFO] Reusing existing resource directory: {resource_dir}", flush=True)
-        return
+        r1_host_path = os.path.join(data_dir_absolute, f"{sample_name}_1{fastq_ext(compress)}")
+        entry += f"{indent}    r1: \"{container_path(r1_host_path, top_level_project_root)}\"\n"
 
-    print(f"[INFO] Creating resource directory: {resource_dir}", flush=True)
-    os.makedirs(resource_dir, exist_ok=True)
+        r2_host_path = os.path.join(data_dir_absolute, f"{sample_name}_2{fastq_ext(compress)}")
+        if os.path.exists(r2_host_path):
+            entry += f"{indent}    r2: \"{container_path(r2_host_path, top_level_project_root)}\"\n"
 
-    vg_index_base_host = os.path.join(top_level_project_root, "resources", "vg", "ecoli_graph_test")
-    linear_base_host = os.path.join(top_level_project_root, "resources", "linear", "ecoli_linear")
-    annotation_gff_host = os.path.join(
-        top_level_project_root, "resources", "annotation", "GCF_000005845.2_ASM584v2_genomic.gff"
-    )
-    centrifuge_index_host = os.path.join(top_level_project_root, "resources", "centrifuge", "p_compressed+h+v")
+        entry += f"{indent}    condition: \"{condition_name}\"\n"
+        sample_entries.append(entry)
+    return "\n".join(sample_entries)
 
-    shutil.copytree(os.path.dirname(vg_index_base_host), os.path.join(resource_dir, "vg"))
-    shutil.copytree(os.path.dirname(linear_base_host), os.path.join(resource_dir, "linear"))
-    shutil.copytree(os.path.dirname(annotation_gff_host), os.path.join(resource_dir, "annotation"))
-    shutil.copytree(os.path.dirname(centrifuge_index_host), os.path.join(resource_dir, "centrifuge"))
 
-    print(f"[INFO] Resource directory populated successfully: {resource_dir}", flush=True)
+def write_config(path, config_content):
+    with open(path, "w") as f:
+        f.write(config_content)
+        f.flush()
+        os.fsync(f.fileno())
 
 
 #Running the snakemake workflow
-def run_pipeline(df: pd.DataFrame, finished_gses: set, resource_dir: str):
+#With batch_size > 1 several GSEs go into one config (experiments: layout) and one snakemake run, so the
+#per-sample jobs of all of them share the cores. Batches run from gse_runs2/batch_{partition}, which links to
+#the GSE folders: outputs land in gse_runs2/{GSE}/ as for single runs, and every partition has its own
+#.snakemake (locks and incomplete markers), kept across restarts however the GSEs are batched
+def run_pipeline(df: pd.DataFrame, finished_gses: set, resource_dir: str, downloader: Downloader, prefetch: int = 1,
+                 resource_mode: str = "auto", batch_size: int = 1, cores: int = None, mem_mb: int = None,
+                 ledger: Ledger = None, partition: str = None, max_attempts: int = 3,
+                 keep_intermediates: bool = False, gam_retention: str = "keep", delete_raw_fastq: bool = False):
 
     ##Actions per metadata file
     df["gse"] = df["gse"].astype(str).str.strip().str.upper()
@@ -161,21 +125,92 @@ def run_pipeline(df: pd.DataFrame, finished_gses: set, resource_dir: str):
     gse_runs_base_dir = os.path.join(pipeline_root_dir, "gse_runs2")
     os.makedirs(gse_runs_base_dir, exist_ok=True)
 
-    #Making sure the resource files are available
-    prepare_resources(resource_dir, top_level_project_root)
+    #Snakemake gets the whole allocation, rules size their threads/memory from their input (see the Snakefile)
+    allocated_cores, allocated_mem_mb = allocated_resources()
+    cores = cores or allocated_cores
+    mem_mb = mem_mb or allocated_mem_mb
+    print(f"[INFO] Running snakemake with {cores} cores and {mem_mb} MB", flush=True)
+
+    #Making sure the resource files are available, paths go to the generation staged now (not the resource_dir
+    #link, which a later restage may point elsewhere) and resources_in_use is held until run_pipeline returns
+    resource_dir, resources_in_use = prepare_resources(resource_dir, top_level_project_root, mode=resource_mode)
     vg_index_final = os.path.join(resource_dir, "vg", "ecoli_graph_test")
-    linear_final = os.path.join(resource_dir, "linear", "ecoli_linear")
     annotation_gff_final = os.path.join(resource_dir, "annotation", "GCF_000005845.2_ASM584v2_genomic.gff")
     annotation_bed_final = os.path.join(resource_dir, "annotation", "GCF_000005845.2_ASM584v2_genomic.bed")
+    gene_annotation_final = os.path.join(resource_dir, "annotation", "GCF_000005845.2_ASM584v2_genes.tsv")
     centrifuge_index_final = os.path.join(resource_dir, "centrifuge", "p_compressed+h+v")
+    scripts_dir_host_path = os.path.join(pipeline_root_dir, "scripts")
 
-    ##Actions per experiment
+    #Gene annotation table from index.sh, the pipeline derives it from the GFF when it has not been built
+    if os.path.exists(gene_annotation_final):
+        gene_annotation_line = f'gene_annotation: "{container_path(gene_annotation_final, top_level_project_root)}"'
+    else:
+        gene_annotation_line = "#gene_annotation: not built, derived from annotation_gff"
+
+    #Config entries shared by every experiment
+    shared_config = f"""deseq2:
+  contrasts: []
+
+vg_index: "{container_path(vg_index_final, top_level_project_root)}"
+ref: "GCF_000005845_2_ASM584v2_genomic#0#NC_000913.3"
+
+annotation_gff: "{container_path(annotation_gff_final, top_level_project_root)}"
+annotation_bed: "{container_path(annotation_bed_final, top_level_project_root)}"
+{gene_annotation_line}
+centrifuge_index_path: "{container_path(centrifuge_index_final, top_level_project_root)}"
+scripts_dir: "{container_path(scripts_dir_host_path, top_level_project_root)}"
+centrifuge_organism: "Escherichia coli"
+centrifuge_min_percentage: 30.0
+fastp_min_kept_percentage: 75.0
+compress_fastq: {"true" if downloader.compress else "false"}
+retention:
+  gam: "{gam_retention}"
+  raw_fastq: "{"delete" if delete_raw_fastq else "keep"}"
+"""
+
+    #Ledger of GSE states, failed GSEs are retried until they reach max_attempts
+    ledger_states = ledger.states(df["gse"].unique()) if ledger is not None else {}
+    def record(gses, state, reason=None):
+        if ledger is not None:
+            ledger.set_state(gses, state, reason=reason, partition=partition)
+
+    #Experiments left to run, downloads for the next ones start while the current one runs
+    pending_gses = []
     for gse_value, group_df in df.groupby("gse"):
         if gse_value in finished_gses:
             print(f"{gse_value} is in the finished list. Skipping.", flush=True)
             continue
-        
-        #Each experiment gets its own directory and snakemake run folder
+        previous = ledger_states.get(gse_value, {})
+        if previous.get("state") == "done":
+            print(f"{gse_value} is done in the ledger. Skipping.", flush=True)
+            continue
+        #In progress in another partition's live job: its run directory and locks belong to that job
+        if (previous.get("state") in ("downloading", "downloaded", "running") and previous["partition"] != partition
+                and time.time() - previous["updated_at"] < STALE_HOURS * 3600):
+            print(f"{gse_value} is {previous['state']} in partition {previous['partition']}. Skipping.", flush=True)
+            continue
+        #Failed, or left in progress by a killed job
+        if previous and previous["attempts"] >= max_attempts:
+            print(f"{gse_value} was started {previous['attempts']} times without finishing "
+                  f"(last state {previous['state']}: {previous['reason']}). Skipping.", flush=True)
+            continue
+        if previous.get("state") == "failed":
+            print(f"Retrying {gse_value}, last failure: {previous['reason']}", flush=True)
+        pending_gses.append((gse_value, group_df))
+    print(f"[INFO] {len(pending_gses)} GSEs to process", flush=True)
+
+    download_futures = {}
+    def start_download(index):
+        if index < len(pending_gses) and index not in download_futures:
+            gse_value, group_df = pending_gses[index]
+            data_dir_absolute = os.path.join(top_level_project_root, "data", gse_value)
+            record(gse_value, "downloading")
+            download_futures[index] = downloader.submit_gse(group_df["gsm"].tolist(), data_dir_absolute)
+
+    #Samples of a downloaded experiment, None if it has to be skipped
+    def collect_samples(gse_index):
+        gse_value, group_df = pending_gses[gse_index]
+        #Each experiment gets its own directory
         gse_run_specific_output_dir = os.path.join(gse_runs_base_dir, gse_value)
         if os.path.exists(gse_run_specific_output_dir):
             print(f"Directory for {gse_value} exists. Resuming...", flush=True)
@@ -183,99 +218,35 @@ def run_pipeline(df: pd.DataFrame, finished_gses: set, resource_dir: str):
         print(f"\nProcessing GSE: {gse_value}", flush=True)
         os.makedirs(gse_run_specific_output_dir, exist_ok=True)
 
-        #Downloading data
-        data_dir_absolute = os.path.join(top_level_project_root, "data", gse_value)
-        os.makedirs(data_dir_absolute, exist_ok=True)
+        #Downloading data (usually already finished or in flight from the previous iteration)
+        gsm_to_char = dict(zip(group_df["gsm"], group_df["characteristics_ch1"]))
         gsm_srr_to_char_map = {}
         all_gse_fastq_paths = []
-        for _, row in group_df.iterrows():
-            gsm = row["gsm"]
-            sample_names_for_gsm, downloaded_paths = download(gsm, data_dir_absolute)
+        for gsm, sample_names_for_gsm, downloaded_paths in download_futures.pop(gse_index).result():
             for sample_name in sample_names_for_gsm:
-                gsm_srr_to_char_map[sample_name] = row["characteristics_ch1"]
+                gsm_srr_to_char_map[sample_name] = gsm_to_char[gsm]
             all_gse_fastq_paths.extend(downloaded_paths)
         #Issues with download
         if not gsm_srr_to_char_map:
             print(f"WARNING: No valid samples found for {gse_value}. Skipping.", flush=True)
-            continue
-        
-        ##Making config file for this experiment
-        #Used for labeling the conditions of samples for DEseq2 in config file
-        unique_characteristics = sorted(list(set(gsm_srr_to_char_map.values())))
-        char_to_condition_name = {char: f"group{i+1}" for i, char in enumerate(unique_characteristics)}
-        #Creating config file using conditions from metadata
-        sample_entries = []
-        for sample_name, char_val in gsm_srr_to_char_map.items():
-            condition_name = char_to_condition_name[char_val]
-            entry = f"  {sample_name}:\n"
-
-            r1_host_path = os.path.join(data_dir_absolute, f"{sample_name}_1.fastq")
-            r1_rel_to_project_root = os.path.relpath(r1_host_path, top_level_project_root)
-            r1_path_in_container = os.path.join("/mnt/project_root", r1_rel_to_project_root)
-            entry += f"    r1: \"{r1_path_in_container}\"\n"
-
-            r2_host_path = os.path.join(data_dir_absolute, f"{sample_name}_2.fastq")
-            if os.path.exists(r2_host_path):
-                r2_rel_to_project_root = os.path.relpath(r2_host_path, top_level_project_root)
-                r2_path_in_container = os.path.join("/mnt/project_root", r2_rel_to_project_root)
-                entry += f"    r2: \"{r2_path_in_container}\"\n"
-
-            entry += f"    condition: \"{condition_name}\"\n"
-            sample_entries.append(entry)
-
-        samples_str = "\n".join(sample_entries)
-        
-        #Necessary paths for config file
-        vg_index_in_container = os.path.join("/mnt/project_root", os.path.relpath(vg_index_final, top_level_project_root))
-        linear_in_container = os.path.join("/mnt/project_root", os.path.relpath(linear_final, top_level_project_root))
-        annotation_gff_in_container = os.path.join(
-            "/mnt/project_root", os.path.relpath(annotation_gff_final, top_level_project_root)
-        )
-        annotation_bed_in_container = os.path.join(
-            "/mnt/project_root", os.path.relpath(annotation_bed_final, top_level_project_root)
-        )
-        centrifuge_index_in_container = os.path.join(
-            "/mnt/project_root", os.path.relpath(centrifuge_index_final, top_level_project_root)
-        )
-        scripts_dir_host_path = os.path.join(pipeline_root_dir, "scripts")
-        scripts_dir_in_container = os.path.join("/mnt/project_root", os.path.relpath(scripts_dir_host_path, top_level_project_root))
-
-        config_content = f"""experiment: "{gse_value}"
-
-samples:
-{samples_str}
-
-deseq2:
-  contrasts: []
-
-vg_index: "{vg_index_in_container}"
-ref: "GCF_000005845_2_ASM584v2_genomic#0#NC_000913.3"
-
-annotation_gff: "{annotation_gff_in_container}"
-annotation_bed: "{annotation_bed_in_container}"
-centrifuge_index_path: "{centrifuge_index_in_container}"
-scripts_dir: "{scripts_dir_in_container}"
-centrifuge_organism: "Escherichia coli"
-centrifuge_min_percentage: 30.0
-fastp_min_kept_percentage: 75.0
-"""
-        config_file_path_for_storage = os.path.join(gse_run_specific_output_dir, f"{gse_value}_config.yaml")
-        with open(config_file_path_for_storage, "w") as f:
-            f.write(config_content)
-            f.flush()
-            os.fsync(f.fileno())
+            record(gse_value, "failed", "no valid samples downloaded")
+            return None
+        if not wait_for_files_to_appear(all_gse_fastq_paths):
+            print(f"ERROR: Not all FASTQ files for GSE {gse_value} were ready. Skipping.", flush=True)
+            record(gse_value, "failed", "FASTQ files not ready after download")
+            return None
+        record(gse_value, "downloaded")
+        return gsm_srr_to_char_map
 
+    #Runs snakemake, returns the exit code (0 on success)
+    def run_snakemake(config_file_path, workdir, label, unlock=True):
         ##Running snakemake using constructed config file
-        print(f"Running Snakemake for {gse_value}...", flush=True)
+        print(f"Running Snakemake for {label}...", flush=True)
         #Setting up apptainer information before running subprocess
         apptainer_project_bind_mount = f"{top_level_project_root}:/mnt/project_root"
         apptainer_bind_mounts = f"--bind \"{apptainer_project_bind_mount}\" --bind \"/tmp:/tmp\""
         snakefile_path_in_container = "/mnt/project_root/pipeline/Snakefile"
-        config_file_path_in_container_mount = os.path.join(
-            "/mnt/project_root",
-            os.path.relpath(gse_run_specific_output_dir, top_level_project_root),
-            f"{gse_value}_config.yaml",
-        )
+        config_file_path_in_container_mount = container_path(config_file_path, top_level_project_root)
         #Snakemake commands
         unlock_cmd = (
             f"apptainer exec {apptainer_bind_mounts} "
@@ -283,56 +254,171 @@ fastp_min_kept_percentage: 75.0
             f"snakemake --unlock "
             f"--snakefile {snakefile_path_in_container} "
             f"--configfile {config_file_path_in_container_mount} "
-            f"--directory {gse_run_specific_output_dir} "
+            f"--directory {workdir} "
         )
 
         snakemake_run_cmd = (
             f"apptainer exec {apptainer_bind_mounts} "
             f"{sif_absolute_path_on_host} "
-            f"snakemake --cores 10 --resources mem_mb=102400 "
+            f"snakemake --cores {cores} --resources mem_mb={mem_mb} "
+            f"--config max_threads={cores} max_mem_mb={mem_mb} " #Per-job requests are capped at the mem_mb budget
+            f"--retries 1 " #Jobs killed for memory get a second attempt with twice the mem_mb (up to the budget)
             f"--rerun-incomplete " #Rerun any rules that were not completed previously in the last run due to walltime/memory issues
-            f"--notemp " #Keep temporary files
+            f"{'--notemp ' if keep_intermediates else ''}" #Temporary files are removed once used unless asked to keep them
             f"--rerun-triggers input " #Only trigger a re-run of a rule if the input is missing (helpful for restarting runs where they left off)
             f"--snakefile {snakefile_path_in_container} "
             f"--configfile {config_file_path_in_container_mount} "
-            f"--directory {gse_run_specific_output_dir} "
+            f"--directory {workdir} "
             f"all"
         )
 
-        if not wait_for_files_to_appear(all_gse_fastq_paths):
-            print(f"ERROR: Not all FASTQ files for GSE {gse_value} were ready. Skipping.", flush=True)
-            continue
         #Unlocking directory for when runs have to be restarted due to wall time
-        print(f"Attempting to unlock directory for {gse_value}...", flush=True)
-        try:
-            subprocess.run(unlock_cmd, shell=True, check=True, cwd=top_level_project_root)
-            print("Successfully unlocked working directory.", flush=True)
-        except subprocess.CalledProcessError as e:
-            print(f"WARNING: Unlock command failed with exit code {e.returncode}.", flush=True)
-
-        print(f"Executing main Snakemake command for {gse_value}...", flush=True)
+        if unlock:
+            print(f"Attempting to unlock directory for {label}...", flush=True)
+            try:
+                subprocess.run(unlock_cmd, shell=True, check=True, cwd=top_level_project_root)
+                print("Successfully unlocked working directory.", flush=True)
+            except subprocess.CalledProcessError as e:
+                print(f"WARNING: Unlock command failed with exit code {e.returncode}.", flush=True)
+
+        print(f"Executing main Snakemake command for {label}...", flush=True)
         try:
             subprocess.run(snakemake_run_cmd, shell=True, check=True, cwd=top_level_project_root)
         except subprocess.CalledProcessError as e:
-            print(f"[WARN] Snakemake failed for {gse_value} with exit code {e.returncode}", flush=True)
+            print(f"[WARN] Snakemake failed for {label} with exit code {e.returncode}", flush=True)
+            return e.returncode
+        return 0
+
+    #Workdir of this partition's batches, with a link to the folder of every GSE in the batch
+    def batch_workdir(gse_names):
+        workdir = os.path.join(gse_runs_base_dir, f"batch_{(partition or 'default').replace(os.sep, '_')}")
+        os.makedirs(workdir, exist_ok=True)
+        for gse_value in gse_names:
+            link = os.path.join(workdir, gse_value)
+            if not os.path.lexists(link):
+                os.symlink(os.path.join("..", gse_value), link)
+        return workdir
+
+    #Only a run killed part way leaves lock files behind, other directories skip the extra snakemake call
+    #No other job runs snakemake in these workdirs: GSE folders belong to the job processing that GSE (GSEs
+    #in progress in another partition are skipped above), and batch workdirs to the partition
+    def needs_unlock(workdir):
+        locks_dir = os.path.join(workdir, ".snakemake", "locks")
+        return os.path.isdir(locks_dir) and bool(os.listdir(locks_dir))
+
+    #Ledger states after a run, in a failed batch each GSE is checked for its own outputs
+    def record_run(gses, returncode):
+        for gse_value in gses:
+            if returncode == 0 or gse_outputs_complete(os.path.join(gse_runs_base_dir, gse_value), gse_value):
+                record(gse_value, "done")
+            else:
+                record(gse_value, "failed", f"snakemake exit code {returncode}")
+
+    ##Actions per experiment (or per batch of experiments)
+    batch_size = max(batch_size, 1)
+    for batch_start in range(0, len(pending_gses), batch_size):
+        batch_indexes = range(batch_start, min(batch_start + batch_size, len(pending_gses)))
+        for ahead in range(batch_start, batch_indexes[-1] + prefetch + 1):
+            start_download(ahead)
+
+        experiments = {}
+        for gse_index in batch_indexes:
+            gsm_srr_to_char_map = collect_samples(gse_index)
+            if gsm_srr_to_char_map is not None:
+                experiments[pending_gses[gse_index][0]] = gsm_srr_to_char_map
+        if not experiments:
+            continue
+
+        ##Making config file for this experiment
+        if batch_size == 1:
+            gse_value, gsm_srr_to_char_map = next(iter(experiments.items()))
+            gse_run_specific_output_dir = os.path.join(gse_runs_base_dir, gse_value)
+            data_dir_absolute = os.path.join(top_level_project_root, "data", gse_value)
+            samples_str = sample_entries_text(
+                gsm_srr_to_char_map, data_dir_absolute, top_level_project_root, downloader.compress,
+            )
+            config_content = f'experiment: "{gse_value}"\n\nsamples:\n{samples_str}\n\n{shared_config}'
+            config_file_path = os.path.join(gse_run_specific_output_dir, f"{gse_value}_config.yaml")
+            write_config(config_file_path, config_content)
+            record(gse_value, "running")
+            returncode = run_snakemake(config_file_path, gse_run_specific_output_dir, gse_value, unlock=needs_unlock(gse_run_specific_output_dir))
+            record_run([gse_value], returncode)
+        else:
+            #One config for the batch, snakemake runs from the partition's batch workdir and writes under {GSE}/
+            experiment_blocks = []
+            for gse_value, gsm_srr_to_char_map in experiments.items():
+                data_dir_absolute = os.path.join(top_level_project_root, "data", gse_value)
+                samples_str = sample_entries_text(
+                    gsm_srr_to_char_map, data_dir_absolute, top_level_project_root, downloader.compress, indent="    ",
+                )
+                experiment_blocks.append(f"  {gse_value}:\n    samples:\n{samples_str}\n")
+            config_content = "experiments:\n" + "\n".join(experiment_blocks) + f"\n{shared_config}"
+            gse_names = list(experiments)
+            label = f"batch_{gse_names[0]}_{gse_names[-1]}"
+            workdir = batch_workdir(gse_names)
+            config_file_path = os.path.join(workdir, f"{label}_config.yaml")
+            write_config(config_file_path, config_content)
+            record(gse_names, "running")
+            returncode = run_snakemake(
+                config_file_path, workdir, f"{label} ({len(gse_names)} GSEs)", unlock=needs_unlock(workdir),
+            )
+            record_run(gse_names, returncode)
 
+    resources_in_use.close()
     print("\nAll GSEs processed. No run directories deleted.")
 
 ##Main function
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: python run_pipeline.py <input_tsv_file> <resource_dir>")
-        sys.exit(1)
-
-    input_file = sys.argv[1]
-    resource_dir = sys.argv[2]
+    parser = argparse.ArgumentParser(description="Run the inGEST Snakemake pipeline for every GSE in a metadata file")
+    parser.add_argument("input_file", help="Tab separated metadata with gse, gsm and characteristics_ch1 columns")
+    parser.add_argument("resource_dir", help="Directory holding the index and annotation files for this job")
+    parser.add_argument("--download-workers", type=int, default=4, help="Number of fasterq-dump processes run at once")
+    parser.add_argument("--download-threads", type=int, default=4, help="Threads given to each fasterq-dump process")
+    parser.add_argument("--prefetch", type=int, default=1, help="Number of upcoming GSEs to download while the current one runs")
+    parser.add_argument(
+        "--batch-size", type=int, default=1,
+        help="GSEs run together in one snakemake invocation (1 keeps one run folder and invocation per GSE)",
+    )
+    parser.add_argument("--compress-fastq", action="store_true", help="Keep downloaded and intermediate FASTQ files gzip compressed")
+    parser.add_argument(
+        "--resource-mode", choices=["auto", "hardlink", "symlink", "copy"], default="auto",
+        help="How resource files are placed in resource_dir (auto: hardlink on the same filesystem, else copy)",
+    )
+    parser.add_argument("--cores", type=int, help="Cores for snakemake (default: slurm allocation or all cores)")
+    parser.add_argument("--mem-mb", type=int, help="Memory for snakemake in MB (default: 90%% of the slurm allocation or machine)")
+    parser.add_argument("--accession-cache", default=default_cache_path(), help="SQLite cache of resolved GSM -> SRR runs")
+    parser.add_argument("--keep-intermediates", action="store_true", help="Keep temp() outputs (snakemake --notemp), e.g. for debugging")
+    parser.add_argument(
+        "--gam", choices=["keep", "gaf", "delete"], default="keep",
+        help="GAM files of finished samples: keep, archive as gzipped GAF, or delete",
+    )
+    parser.add_argument("--delete-raw-fastq", action="store_true", help="Delete downloaded FASTQs once an experiment's counts and QC are done")
+    parser.add_argument("--ledger", default=default_ledger_path(), help="SQLite ledger of GSE states shared by all partitions")
+    parser.add_argument("--partition", help="Name recorded in the ledger for this job (default: input file name)")
+    parser.add_argument("--max-attempts", type=int, default=3, help="Unfinished GSEs are retried until they have been started this many times")
+    args = parser.parse_args()
 
-    df = pd.read_csv(input_file, sep="\t")
+    df = pd.read_csv(args.input_file, sep="\t")
     required_cols = {"gse", "gsm", "characteristics_ch1"}
     if not required_cols.issubset(df.columns):
         missing = required_cols - set(df.columns)
         raise ValueError(f"Missing required columns: {missing}")
 
     finished_gses = get_finished_gses()
-    run_pipeline(df, finished_gses, resource_dir)
-
+    downloader = Downloader(
+        dump_workers=args.download_workers,
+        dump_threads=args.download_threads,
+        cache=AccessionCache(args.accession_cache),
+        compress=args.compress_fastq,
+    )
+    try:
+        run_pipeline(
+            df, finished_gses, args.resource_dir, downloader,
+            prefetch=args.prefetch, resource_mode=args.resource_mode, batch_size=args.batch_size,
+            cores=args.cores, mem_mb=args.mem_mb,
+            ledger=Ledger(args.ledger), partition=args.partition or os.path.basename(args.input_file),
+            max_attempts=args.max_attempts, keep_intermediates=args.keep_intermediates,
+            gam_retention=args.gam, delete_raw_fastq=args.delete_raw_fastq,
+        )
+    finally:
+        downloader.shutdown()
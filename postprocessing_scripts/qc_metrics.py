@@ -0,0 +1,227 @@
+#Collecting per-sample QC metrics from finished GSE runs (replaces qc_parse.sh / cyverse_qc)
+#One parser per artifact type, samples are parsed in a process pool and an mtime manifest
+#means re-runs only parse samples whose files changed
+import os
+import re
+import sys
+import glob
+import json
+import zipfile
+import argparse
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+
+COLUMNS = [
+    "sample", "strandedness_fraction", "tRNA_fraction", "rRNA_fraction", "contamination_fraction",
+    "paired_single_end", "GC_bias_fraction", "Total_reads", "fraction_aligned", "fraction_perfect",
+]
+
+#Files looked for inside each sample directory
+ARTIFACTS = {
+    "infer_experiment": "*_infer_experiment.txt",
+    "feature_overlap": "*_feature_overlap_mqc.tsv",
+    "centrifuge": "*_report.txt",
+    "fastqc_r1": "*_clean_R1_fastqc.zip",
+    "fastqc_r2": "*_clean_R2_fastqc.zip",
+    "giraffe": "*_giraffe.stats.txt",
+}
+
+
+####Parsers (each returns a dict of metric -> formatted string)
+
+#Strandedness (already a fraction from rseqc, the last "explained by" line like cyverse_qc)
+def parse_infer_experiment(path):
+    value = "NA"
+    with open(path) as fh:
+        for line in fh:
+            if "Fraction of reads explained" in line and ":" in line:
+                value = line.split(":", 1)[1].strip() or value
+    return {"strandedness_fraction": value}
+
+
+#tRNA / rRNA (raw values are %, convert to fraction)
+def parse_feature_overlap(path):
+    fractions = {"tRNA_fraction": "NA", "rRNA_fraction": "NA"}
+    with open(path) as fh:
+        for line in fh:
+            fields = line.split()
+            if len(fields) < 2 or fields[0] not in ("tRNA", "rRNA"):
+                continue
+            key = f"{fields[0]}_fraction"
+            if fractions[key] == "NA" and re.fullmatch(r"[0-9.]+", fields[1]):
+                fractions[key] = f"{float(fields[1]) / 100:.4f}"
+    return fractions
+
+
+#Contamination (raw is %, convert to fraction)
+def parse_centrifuge(path, organism=("Escherichia", "coli")):
+    with open(path) as fh:
+        for line in fh:
+            fields = line.split()
+            if tuple(fields[5:7]) == organism:
+                return {"contamination_fraction": f"{(100 - float(fields[0])) / 100:.4f}"}
+    return {"contamination_fraction": "NA"}
+
+
+#GC bias (raw is %, convert to fraction) + total reads, read from the zip without extracting it
+def parse_fastqc(path):
+    metrics = {"GC_bias_fraction": "NA", "Total_reads": "NA"}
+    with zipfile.ZipFile(path) as zf:
+        members = [m for m in zf.namelist() if m.endswith("fastqc_data.txt")]
+        if not members:
+            return metrics
+        with zf.open(members[0]) as fh:
+            lines = fh.read().decode().splitlines()
+
+    gc_sum = 0.0
+    gc_count = 0
+    in_gc = in_basic = False
+    for line in lines:
+        if line.startswith(">>Basic Statistics"):
+            in_basic = True
+        elif line.startswith(">>Per base sequence content"):
+            in_gc = True
+            continue
+        elif line.startswith(">>END_MODULE"):
+            in_gc = in_basic = False
+        if in_gc and not line.startswith("#"):
+            gc_sum += float(line.split("\t")[1])
+            gc_count += 1
+        if in_basic and line.startswith("Total Sequences"):
+            metrics["Total_reads"] = line.split()[2]
+    if gc_count:
+        metrics["GC_bias_fraction"] = f"{gc_sum / gc_count / 100:.4f}"
+    return metrics
+
+
+#Alignment fractions
+def parse_giraffe(path):
+    counts = {}
+    with open(path) as fh:
+        for line in fh:
+            for key in ("Total alignments:", "Total aligned:", "Total perfect:"):
+                if line.startswith(key):
+                    counts[key] = int(line.split()[2])
+    metrics = {"fraction_aligned": "NA", "fraction_perfect": "NA"}
+    total = counts.get("Total alignments:", 0)
+    aligned = counts.get("Total aligned:", 0)
+    if total > 0:
+        metrics["fraction_aligned"] = f"{aligned / total:.4f}"
+        if aligned > 0:
+            metrics["fraction_perfect"] = f"{counts.get('Total perfect:', 0) / aligned:.4f}"
+    return metrics
+
+
+PARSERS = {
+    "infer_experiment": parse_infer_experiment,
+    "feature_overlap": parse_feature_overlap,
+    "centrifuge": parse_centrifuge,
+    "fastqc_r1": parse_fastqc,
+    "giraffe": parse_giraffe,
+}
+
+
+####Sample discovery
+
+#Sample directories under a run root: GSE*/GSE*_results/GSM* (cluster runs) or GSE*/GSM* (staged copies)
+def find_sample_dirs(root):
+    sample_dirs = {}
+    for pattern in ("GSE*/*_results/GSM*", "GSE*/GSM*"):
+        for d in sorted(glob.glob(os.path.join(root, pattern))):
+            if os.path.isdir(d):
+                sample_dirs.setdefault(os.path.basename(d), d)
+    return sample_dirs
+
+
+#Sample directories from a labels file (sample, GSE, ...) as used by cyverse_qc
+def sample_dirs_from_labels(labels_file, root):
+    sample_dirs = {}
+    with open(labels_file) as fh:
+        for line in fh:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 2:
+                sample_dirs[fields[0]] = os.path.join(root, fields[1], fields[0])
+    return sample_dirs
+
+
+#Artifact paths and their mtimes for a sample, the manifest key for deciding whether to re-parse
+def artifact_state(sample, sample_dir):
+    state = {}
+    if not os.path.isdir(sample_dir):
+        return state
+    for name, pattern in ARTIFACTS.items():
+        matches = sorted(glob.glob(os.path.join(sample_dir, "**", pattern), recursive=True))
+        if matches:
+            state[name] = [matches[0], os.path.getmtime(matches[0])]
+    return state
+
+
+def collect_sample(sample, state):
+    row = {column: "NA" for column in COLUMNS}
+    row["sample"] = sample
+    if not state:
+        return row
+    row["paired_single_end"] = "Paired" if "fastqc_r2" in state else "Single"
+    for name, parser in PARSERS.items():
+        if name not in state:
+            continue
+        try:
+            row.update(parser(state[name][0]))
+        except (OSError, ValueError, IndexError, zipfile.BadZipFile) as e:
+            print(f"[WARN] Could not parse {state[name][0]}: {e}", file=sys.stderr, flush=True)
+    return row
+
+
+def load_manifest(path):
+    if path and os.path.exists(path):
+        with open(path) as fh:
+            return json.load(fh)
+    return {}
+
+
+def collect(sample_dirs, manifest, workers):
+    states = {sample: artifact_state(sample, d) for sample, d in sample_dirs.items()}
+    stale = [s for s, state in states.items() if manifest.get(s, {}).get("state") != state]
+    print(f"[INFO] {len(sample_dirs)} samples, {len(stale)} to parse", flush=True)
+
+    rows = {s: manifest[s]["row"] for s in sample_dirs if s not in stale}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for sample, row in zip(stale, pool.map(collect_sample, stale, [states[s] for s in stale], chunksize=64)):
+            rows[sample] = row
+            manifest[sample] = {"state": states[sample], "row": row}
+    return [rows[s] for s in sample_dirs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collect per-sample QC metrics into sample_metrics.tsv")
+    parser.add_argument("--root", default=".", help="Directory holding the GSE run folders")
+    parser.add_argument("--labels", help="Optional labels file (sample, GSE) with samples staged under --root/GSE/sample")
+    parser.add_argument("--output", default="sample_metrics.tsv")
+    parser.add_argument("--parquet", help="Also write the table as Parquet (needs pyarrow)")
+    parser.add_argument("--manifest", default="sample_metrics.manifest.json", help="mtime manifest used for incremental runs")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.labels:
+        sample_dirs = sample_dirs_from_labels(args.labels, args.root)
+    else:
+        sample_dirs = find_sample_dirs(args.root)
+
+    manifest = load_manifest(args.manifest)
+    rows = collect(sample_dirs, manifest, args.workers)
+
+    df = pd.DataFrame(rows, columns=COLUMNS)
+    df.to_csv(args.output, sep="\t", index=False)
+    if args.parquet:
+        df.replace("NA", None).to_parquet(args.parquet, index=False)
+
+    tmp_manifest = f"{args.manifest}.tmp"
+    with open(tmp_manifest, "w") as fh:
+        json.dump(manifest, fh)
+    os.replace(tmp_manifest, args.manifest)
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
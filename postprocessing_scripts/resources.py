@@ -0,0 +1,195 @@
+import os
+import re
+import json
+import fcntl
+import shutil
+import hashlib
+from contextlib import contextmanager
+
+#Shared staging of the reference resources (vg graph, linear index, annotation, centrifuge index)
+#A checksum manifest of the source files is kept next to them (or next to the staged directory when the
+#source tree is read-only) and only re-hashed for files whose size/mtime changed. Every version of the
+#sources is staged once, as a generation directory {resource_dir}.{manifest hash}, under a file lock so
+#concurrent jobs on a node wait for one copy instead of making their own; resource_dir is a symlink to the
+#newest generation. Jobs hold a shared lock on the generation they use for as long as they run, and older
+#generations are only removed once nobody holds theirs, so restaging never pulls indexes from under a job.
+#Files are hardlinked when source and destination share a filesystem, otherwise symlinked or copied.
+
+RESOURCE_SUBDIRS = ["vg", "linear", "annotation", "centrifuge"]
+MANIFEST_NAME = ".resources_manifest.json"
+
+
+@contextmanager
+def locked(lock_path):
+    with open(lock_path, "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def sha256(path, block_size=1 << 24):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(path):
+    if os.path.exists(path):
+        with open(path) as fh:
+            return json.load(fh)
+    return {}
+
+
+def write_manifest(path, manifest):
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with open(tmp, "w") as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+#{relative path: {size, mtime_ns, sha256}} for every file in the resource subdirectories
+#(the manifest is kept in fallback_path when the source directory is not writable)
+def source_manifest(source_root, subdirs=RESOURCE_SUBDIRS, fallback_path=None):
+    manifest_path = os.path.join(source_root, MANIFEST_NAME)
+    writable = os.access(source_root, os.W_OK) and (not os.path.exists(manifest_path) or os.access(manifest_path, os.W_OK))
+    if not writable and fallback_path is not None:
+        manifest_path = fallback_path
+    with locked(f"{manifest_path}.lock"):
+        previous = read_manifest(manifest_path)
+        manifest = {}
+        for subdir in subdirs:
+            for dirpath, _, filenames in os.walk(os.path.join(source_root, subdir)):
+                for name in sorted(filenames):
+                    path = os.path.join(dirpath, name)
+                    rel = os.path.relpath(path, source_root)
+                    st = os.stat(path)
+                    entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+                    old = previous.get(rel, {})
+                    if old.get("size") == entry["size"] and old.get("mtime_ns") == entry["mtime_ns"]:
+                        entry["sha256"] = old["sha256"]
+                    else:
+                        print(f"[INFO] Checksumming {rel}", flush=True)
+                        entry["sha256"] = sha256(path)
+                    manifest[rel] = entry
+        if manifest != previous:
+            write_manifest(manifest_path, manifest)
+    return manifest
+
+
+def same_filesystem(a, b):
+    return os.stat(a).st_dev == os.stat(b).st_dev
+
+
+#Placing one file in the staging directory, returns the mode actually used
+def place_file(src, dst, mode):
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            mode = "copy"
+    if mode == "symlink":
+        #Relative links so the paths still resolve inside the container bind mount
+        os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst)
+        return "symlink"
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+#Generation directory of a manifest, named after its hash so unchanged sources map to the same directory
+def generation_dir(resource_dir, manifest):
+    digest = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+    return f"{os.path.abspath(resource_dir)}.{digest[:12]}"
+
+
+def stage(source_root, generation, manifest, mode):
+    parent = os.path.dirname(generation)
+    if mode == "auto":
+        mode = "hardlink" if same_filesystem(source_root, parent) else "copy"
+    staging_dir = f"{generation}.staging.{os.getpid()}"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+    used = set()
+    for rel, entry in manifest.items():
+        src = os.path.join(source_root, rel)
+        dst = os.path.join(staging_dir, rel)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        used.add(place_file(src, dst, mode))
+        #Copies are checked against the manifest, links point at the checksummed file itself
+        if os.path.islink(dst) or os.path.samefile(src, dst):
+            continue
+        if os.path.getsize(dst) != entry["size"] or sha256(dst) != entry["sha256"]:
+            raise RuntimeError(f"Checksum mismatch after copying {rel} to {staging_dir}")
+
+    write_manifest(os.path.join(staging_dir, MANIFEST_NAME), manifest)
+    os.rename(staging_dir, generation)
+    return used
+
+
+#Pointing resource_dir at a generation (a relative symlink, so it also resolves inside the container)
+def point_to(resource_dir, generation):
+    resource_dir = os.path.abspath(resource_dir)
+    tmp = f"{resource_dir}.link.{os.getpid()}"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(os.path.basename(generation), tmp)
+    os.replace(tmp, resource_dir)
+
+
+#Removing generations other than keep that no job holds a lock on
+def reap_generations(resource_dir, keep):
+    pattern = re.compile(re.escape(os.path.basename(os.path.abspath(resource_dir))) + r"\.[0-9a-f]{12}$")
+    parent = os.path.dirname(os.path.abspath(resource_dir))
+    for name in os.listdir(parent):
+        path = os.path.join(parent, name)
+        if not pattern.match(name) or path == keep or not os.path.isdir(path):
+            continue
+        with open(f"{path}.lock", "a") as fh:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print(f"[INFO] Keeping {name}, still used by a running job", flush=True)
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            os.remove(f"{path}.lock")
+            print(f"[INFO] Removed unused resource generation {name}", flush=True)
+
+
+#Making sure resource_dir points at the current resources, staging them if the source has changed
+#Returns the generation directory to use and an open lock file: the shared lock on it marks the generation
+#as in use until the file is closed (or the process exits), keep it open for as long as the job runs
+def ensure_resources(source_root, resource_dir, mode="auto"):
+    resource_dir = os.path.abspath(resource_dir)
+    parent = os.path.dirname(resource_dir)
+    os.makedirs(parent, exist_ok=True)
+    fallback = os.path.join(parent, f".{os.path.basename(resource_dir)}{MANIFEST_NAME}")
+    manifest = source_manifest(source_root, fallback_path=fallback)
+    if not manifest:
+        raise FileNotFoundError(f"No resource files found under {source_root}")
+
+    generation = generation_dir(resource_dir, manifest)
+    with locked(f"{resource_dir}.lock"):
+        #resource_dir staged as a plain directory by older versions becomes a generation of its own
+        if os.path.isdir(resource_dir) and not os.path.islink(resource_dir):
+            os.rename(resource_dir, generation_dir(resource_dir, read_manifest(os.path.join(resource_dir, MANIFEST_NAME))))
+
+        if read_manifest(os.path.join(generation, MANIFEST_NAME)) == manifest:
+            print(f"[INFO] Reusing existing resource directory: {generation}", flush=True)
+        else:
+            if os.path.lexists(resource_dir):
+                print(f"[INFO] Source resources changed, staging {generation}", flush=True)
+            else:
+                print(f"[INFO] Creating resource directory: {generation}", flush=True)
+            shutil.rmtree(generation, ignore_errors=True)
+            used = stage(source_root, generation, manifest, mode)
+            print(f"[INFO] Resource directory populated successfully ({', '.join(sorted(used))}): {generation}", flush=True)
+        point_to(resource_dir, generation)
+
+        in_use = open(f"{generation}.lock", "a")
+        fcntl.flock(in_use, fcntl.LOCK_SH)
+        reap_generations(resource_dir, generation)
+    return generation, in_use
@@ -43,3 +43,6 @@ cactus-pangenome ./jobstore genomes.txt \
 ##ANNOTATION FILES##
 grep -v "^#" GCF_000005845.2_ASM584v2_genomic.gtf | awk -v OFS='\t' '{print $1,$4,$5,$24":"$10,$6,$7}' | sed 's/\.3//g; s/[";]//g' > GCF_000005845.2_ASM584v2_genomic.bed
 
+#Gene symbol/summary table used to annotate the counts, Gene_Summary holds the NCBI gene summaries (one esummary
+#pass here, genes without one keep the GFF product)
+python ../pipeline/scripts/gene_annotation.py build --gff GCF_000005845.2_ASM584v2_genomic.gff --output GCF_000005845.2_ASM584v2_genes.tsv --ncbi-summaries
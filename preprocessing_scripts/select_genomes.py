@@ -1,59 +1,155 @@
-import pickle
+import os
+import hashlib
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from scipy.cluster.hierarchy import fcluster, dendrogram, linkage
 import seaborn as sns
 from matplotlib.patches import Patch
-from scipy.spatial.distance import squareform
+
+
+#####SETTINGS######
+
+#Mash output and cache location (cache is keyed on file contents, so a new mash run is picked up automatically)
+distances_file = "mash_distances.tsv"
+cache_dir = "select_genomes_cache"
+
+#Known outliers removed before clustering
+outliers = ["genomes/GCF_021307345.1_ASM2130734v1_genomic.fna"]
+
+#Clustering threshold
+threshold = 0.015
+
+
+#####HELPER FUNCTIONS######
+
+#Position of pair (i, j) in a condensed distance array (same layout as scipy squareform)
+def condensed_index(i, j, n):
+    i = np.asarray(i, dtype=np.int64)
+    j = np.asarray(j, dtype=np.int64)
+    lo = np.minimum(i, j)
+    hi = np.maximum(i, j)
+    return n * lo - (lo * (lo + 1)) // 2 + (hi - lo - 1)
+
+#Hashing the mash output in blocks so the cache is invalidated when the file changes
+def file_hash(path, block_size=1 << 24):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+#Streaming mash distances in fixed-size chunks into a memory-mapped float32 condensed array
+#Genome paths are interned to integer ids as they are seen, and (id1, id2, distance) triplets are
+#spilled to disk so peak memory scales with the chunk size rather than the number of pairs
+def load_distances(path, out_dir, chunk_rows=5_000_000):
+    pair_dtype = np.dtype([("i", np.int32), ("j", np.int32), ("d", np.float32)])
+    pairs_file = os.path.join(out_dir, "pairs.bin")
+    genome_ids = {}
+    n_pairs = 0
+
+    reader = pd.read_csv(
+        path, sep="\t", header=None, usecols=[0, 1, 2],
+        names=["genome1", "genome2", "distance"],
+        dtype={"genome1": str, "genome2": str, "distance": np.float32},
+        chunksize=chunk_rows,
+    )
+    with open(pairs_file, "wb") as out:
+        for chunk in reader:
+            codes, uniques = pd.factorize(pd.concat([chunk["genome1"], chunk["genome2"]], ignore_index=True))
+            lookup = np.empty(len(uniques), dtype=np.int32)
+            for k, name in enumerate(uniques):
+                lookup[k] = genome_ids.setdefault(name, len(genome_ids))
+            ids = lookup[codes]
+            records = np.empty(len(chunk), dtype=pair_dtype)
+            records["i"] = ids[:len(chunk)]
+            records["j"] = ids[len(chunk):]
+            records["d"] = chunk["distance"].to_numpy()
+            records[records["i"] != records["j"]].tofile(out)
+            n_pairs += len(chunk)
+            print(f"[INFO] Parsed {n_pairs} rows, {len(genome_ids)} genomes", flush=True)
+
+    #Genomes are kept in sorted order, so interned ids are remapped to their sorted rank
+    genomes = np.array(sorted(genome_ids))
+    rank = np.empty(len(genomes), dtype=np.int64)
+    rank[list(genome_ids.values())] = np.searchsorted(genomes, list(genome_ids.keys()))
+
+    n = len(genomes)
+    condensed = np.lib.format.open_memmap(
+        os.path.join(out_dir, "condensed.npy"), mode="w+", dtype=np.float32, shape=(n * (n - 1) // 2,)
+    )
+    pairs = np.memmap(pairs_file, dtype=pair_dtype, mode="r")
+    for start in range(0, len(pairs), chunk_rows):
+        block = pairs[start:start + chunk_rows]
+        condensed[condensed_index(rank[block["i"]], rank[block["j"]], n)] = block["d"]
+    condensed.flush()
+    del pairs, condensed
+    os.remove(pairs_file)
+
+    np.save(os.path.join(out_dir, "genomes.npy"), genomes)
+
+#Pulling the distances for a subset of genomes out of a condensed array one row at a time,
+#so the index arrays stay O(n) instead of O(n^2)
+def subset_condensed(condensed, n, keep):
+    keep = np.asarray(keep, dtype=np.int64)
+    m = len(keep)
+    subset = np.empty(m * (m - 1) // 2, dtype=np.float32)
+    offset = 0
+    for r in range(m - 1):
+        cols = keep[r + 1:]
+        subset[offset:offset + len(cols)] = condensed[condensed_index(keep[r], cols, n)]
+        offset += len(cols)
+    return subset
+
+#Distances for the kept genomes, the full array itself when nothing was removed
+def kept_condensed(condensed, n, keep):
+    if len(keep) == n:
+        return condensed
+    return subset_condensed(condensed, n, keep)
+
+#Loading parsed distances from the cache (memory-mapped), parsing mash output only on a miss
+def cached_distances(path, cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    key = file_hash(path)
+    out_dir = os.path.join(cache_dir, f"distances_{key[:16]}")
+    if os.path.exists(os.path.join(out_dir, "genomes.npy")):
+        print(f"[INFO] Loading cached distances: {out_dir}", flush=True)
+    else:
+        print("building matrix", flush=True)
+        os.makedirs(out_dir, exist_ok=True)
+        load_distances(path, out_dir)
+    genomes = np.load(os.path.join(out_dir, "genomes.npy"))
+    condensed = np.load(os.path.join(out_dir, "condensed.npy"), mmap_mode="r")
+    return key, genomes, condensed
+
+#Loading the linkage matrix from the cache, keyed on the distances and the outlier list
+#The distances for the kept genomes are only assembled on a cache miss
+def cached_linkage(key, excluded, cache_dir, get_condensed):
+    linkage_key = hashlib.sha256("\n".join([key] + sorted(excluded)).encode()).hexdigest()
+    cache_file = os.path.join(cache_dir, f"linkage_{linkage_key[:16]}.npy")
+    if os.path.exists(cache_file):
+        print(f"[INFO] Loading cached linkage matrix: {cache_file}", flush=True)
+        return np.load(cache_file)
+
+    print("clustering matrix", flush=True)
+    Z = linkage(get_condensed(), method="average")
+    np.save(cache_file, Z)
+    return Z
 
 
 #####MAKING MATRIX######
 
 #Loading mash distances
-df = pd.read_csv("mash_distances.tsv", sep='\t', header=None)
-df.columns = ["genome1", "genome2", "distance", "pvalue", "shared"]
-
-#Removing known outlier
-outlier = "genomes/GCF_021307345.1_ASM2130734v1_genomic.fna"
-df = df[~df["genome1"].eq(outlier) & ~df["genome2"].eq(outlier)]
-
-#Creating list of genomes
-genomes = sorted(set(df["genome1"]).union(set(df["genome2"])))
-genome_to_idx = {g: i for i, g in enumerate(genomes)}
-
-print("building matrix", flush=True)
-#Building distance matrix
-n = len(genomes)
-dist_matrix = np.zeros((n, n))
-for _, row in df.iterrows():
-    i = genome_to_idx[row["genome1"]]
-    j = genome_to_idx[row["genome2"]]
-    dist = row["distance"]
-    dist_matrix[i, j] = dist
-    dist_matrix[j, i] = dist
-
-#Clustering matrix
-condensed = squareform(dist_matrix)
-Z = linkage(condensed, method="average")
-
-#Saving matrix (for making figures etc so it doesnt have to be recalculated)
-with open("linkage_matrix.pkl", "wb") as f:
-    pickle.dump(Z, f)
-
-#Loading matrix
-with open("linkage_matrix.pkl", "rb") as f:
-    Z = pickle.load(f)
-
-#Getting genome names
-df = pd.read_csv("mash_distances.tsv", sep='\t', header=None)
-df.columns = ["genome1", "genome2", "distance", "pvalue", "shared"]
-outlier = "genomes/GCF_021307345.1_ASM2130734v1_genomic.fna"  #Removing outlier from names
-df = df[~df["genome1"].eq(outlier) & ~df["genome2"].eq(outlier)]
-genomes = sorted(set(df["genome1"]).union(set(df["genome2"])))
+key, all_genomes, all_condensed = cached_distances(distances_file, cache_dir)
+
+#Removing known outliers
+keep = np.flatnonzero(~np.isin(all_genomes, outliers))
+genomes = all_genomes[keep].tolist()
+
+#Clustering matrix (cached so changing the threshold only redoes fcluster and plotting)
+Z = cached_linkage(key, outliers, cache_dir, lambda: kept_condensed(all_condensed, len(all_genomes), keep))
 
 #Setting clustering threshold
-threshold = 0.015
 clusters = fcluster(Z, t=threshold, criterion='distance')
 
 #Force K-12 to be the selected genome for its cluster
@@ -66,9 +162,7 @@ original_cluster_id = clusters[forced_index]
 forced_cluster_id = max(clusters) + 1
 new_cluster_id_for_others = forced_cluster_id + 1
 new_clusters = clusters.copy()
-for i, c in enumerate(clusters):
-    if c == original_cluster_id and i != forced_index:
-        new_clusters[i] = new_cluster_id_for_others
+new_clusters[clusters == original_cluster_id] = new_cluster_id_for_others
 new_clusters[forced_index] = forced_cluster_id
 clusters = new_clusters
 if len(genomes) != len(clusters):
@@ -159,32 +253,14 @@ plt.close()
 
 ##REPRESENTATIVE GENOMES##
 
-#Load representative genomes
-reps_df = pd.read_csv("representative_genomes.csv")
-rep_genomes = set(reps_df["genome"])
-
-#Load mash distances
-df = pd.read_csv("mash_distances.tsv", sep='\t', header=None)
-df.columns = ["genome1", "genome2", "distance", "pvalue", "shared"]
-
-#Filter for representatives
-rep_df = df[df["genome1"].isin(rep_genomes) & df["genome2"].isin(rep_genomes)]
-
-#Build matrix
-rep_list = sorted(rep_genomes)
-rep_index = {g: i for i, g in enumerate(rep_list)}
+#Representative genomes, pulled from the cached distances instead of re-reading mash output
+rep_list = sorted(representatives["genome"])
+genome_to_idx = {g: i for i, g in enumerate(all_genomes.tolist())}
+rep_condensed = subset_condensed(all_condensed, len(all_genomes), [genome_to_idx[g] for g in rep_list])
 n = len(rep_list)
-dist_matrix = np.zeros((n, n))
-
-for _, row in rep_df.iterrows():
-    i = rep_index[row["genome1"]]
-    j = rep_index[row["genome2"]]
-    dist_matrix[i, j] = row["distance"]
-    dist_matrix[j, i] = row["distance"]
 
-#Condense and cluster
-condensed = squareform(dist_matrix)
-Z = linkage(condensed, method="average")
+#Clustering
+Z = linkage(rep_condensed, method="average")
 
 #Plotting dendrogram
 plt.figure(figsize=(max(12, n * 0.15), 6))
@@ -193,5 +269,3 @@ plt.title("Dendrogram of Representative Genomes (1 per Cluster)")
 plt.tight_layout()
 plt.savefig("representative_dendrogram.png")
 plt.close()
-
-